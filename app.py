@@ -3,20 +3,45 @@ import logging
 from pathlib import Path
 import fitz
 import json
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, make_response, g
 from flask_socketio import SocketIO, emit
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_chroma import Chroma
-from langchain.prompts import PromptTemplate
-from langchain.text_splitter import CharacterTextSplitter
+# LangChain, Chroma and the OpenAI SDK take seconds to import, so they are imported where they
+# are first used; warm_up loads them in the background before the first query needs them
 from io import BytesIO
-from PIL import Image
-import uuid
+from PIL import Image, features as pil_features
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from collections import OrderedDict, deque
+from itertools import islice
+from array import array
+import sqlite3
+import threading
+import queue
+import gzip
+import math
+import re
+import string
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+import hashlib
+import random
 import time
+import functools
+import itertools
+import mmap
+import struct
+import contextvars
+import hmac
+import sys
+import uuid
+import atexit
+import importlib.machinery
 
 try:
-    import pytesseract
+    from ocr_worker import ocr_image  # Imports pytesseract
     OCR_AVAILABLE = True
 except ImportError:
     OCR_AVAILABLE = False
@@ -31,259 +56,2236 @@ logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
-socketio = SocketIO(app, cors_allowed_origins="*")
+app.config['SECRET_KEY'] = os.getenv("SECRET_KEY") or os.urandom(24)  # Set when running several workers
+# With a message queue (e.g. redis://localhost:6379/0) several workers behind a sticky load
+# balancer share Socket.IO rooms, so any worker can emit to any client. Threading mode because
+# the blocking work runs in thread pools and the Redis queue client needs real threads
+socketio = SocketIO(app, async_mode="threading", cors_allowed_origins="*",
+                    message_queue=os.getenv("SOCKETIO_MESSAGE_QUEUE"))
 
 # Configuration
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OPENAI_API_KEY not set.")
+api_key = os.getenv("OPENAI_API_KEY")  # Checked by warm_up, so the static and PDF routes work without it
 base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1/")
+debug_mode = os.getenv("DEBUG", "false").lower() == "true"  # Flask debugger and code reloader
 pdf_path = "./Examination-Manual-2024-25--2.pdf"  # Update as needed
 persist_directory = "./chroma_db"
 summary_collection_name = "examination_manual_summaries"
 chunk_collection_name = "examination_manual_chunks"
+document_collection_name = "corpus_documents"  # One summary per document, used to route queries
+corpus_directory = os.getenv("CORPUS_DIR")  # Serve every PDF in this directory alongside the examination manual
+corpus_max_workers = int(os.getenv("CORPUS_MAX_WORKERS", "4"))  # Documents ingested concurrently
+route_top_documents = int(os.getenv("ROUTE_TOP_DOCUMENTS", "3"))  # Documents searched per query (0 = all)
+retrieval_max_workers = int(os.getenv("RETRIEVAL_MAX_WORKERS", "8"))  # Document searches run in parallel per query
+manifest_path = os.path.join(persist_directory, "ingestion_manifest.json")
+lexical_index_path = os.path.join(persist_directory, "bm25_index.json.gz")
 max_history = 3  # Number of past exchanges to retain for context
+history_summary_turns = int(os.getenv("HISTORY_SUMMARY_TURNS", "10"))  # Older exchanges kept as one-line summaries
+prompt_token_budget = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))  # Max prompt tokens for an answer
+history_token_budget = int(os.getenv("HISTORY_TOKEN_BUDGET", "600"))  # Max prompt tokens spent on conversation history
+history_answer_tokens = 150  # Recent answers are shortened to this many tokens in the prompt
+tokenizer_model = os.getenv("TOKENIZER_MODEL", "gpt-3.5-turbo")  # tiktoken encoding used to count prompt tokens
+# tiktoken downloads its encoding file on first use; keep it next to the other caches, not in /tmp
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.abspath("./tiktoken_cache"))
+session_store_backend = os.getenv("SESSION_STORE", "memory")  # "memory", "sqlite" or "redis"
+session_store_path = os.getenv("SESSION_STORE_PATH", "./sessions.db")  # SQLite store, shared by workers on one host
+session_store_url = os.getenv("SESSION_STORE_URL", "redis://localhost:6379/0")  # Redis store, shared across hosts
+session_ttl = float(os.getenv("SESSION_TTL", "86400"))  # Seconds an idle session's history is kept
+session_max_entries = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))  # Sessions kept (least recently used are evicted)
+response_error_message = "Sorry, I couldn't generate a response due to a technical issue. Please try again or rephrase your question."
+summary_max_workers = int(os.getenv("SUMMARY_MAX_WORKERS", "8"))  # Max summaries in flight during ingestion
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "100"))  # Texts per embedding request
+embedding_max_workers = int(os.getenv("EMBEDDING_MAX_WORKERS", "4"))  # Max embedding requests in flight
+api_max_retries = int(os.getenv("API_MAX_RETRIES", "5"))  # Retries on rate-limit/transient API errors
+ingest_batch_size = int(os.getenv("INGEST_BATCH_SIZE", "32"))  # Chunks embedded and committed together during ingestion
+ocr_max_workers = int(os.getenv("OCR_MAX_WORKERS", str(os.cpu_count() or 1)))  # OCR processes during ingestion
+ocr_cache_path = os.getenv("OCR_CACHE_PATH", "./ocr_cache.db")
+ocr_render_dpi = int(os.getenv("OCR_RENDER_DPI", "300"))  # DPI for pages rendered before OCR
+ocr_min_image_dpi = int(os.getenv("OCR_MIN_IMAGE_DPI", "150"))  # Embedded images below this are OCR'd from a page render
+ocr_config = "--psm 6"
+embedding_model = "text-embedding-ada-002"
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.db")
+embedding_cache_max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))  # Rows kept on disk
+embedding_cache_memory_entries = int(os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", "10000"))  # Hot rows kept in memory
+vector_backend = os.getenv("VECTOR_BACKEND", "chroma")  # "chroma" or "numpy"
+numpy_vector_dtype = os.getenv("NUMPY_VECTOR_DTYPE", "float32")  # "float32", "float16" or "int8"
+numpy_flush_rows = int(os.getenv("NUMPY_FLUSH_ROWS", "4096"))  # Changed rows a NumPy store buffers before writing to disk
+hybrid_retrieval = os.getenv("HYBRID_RETRIEVAL", "true").lower() == "true"  # Fuse BM25 and vector rankings
+rrf_k = int(os.getenv("RRF_K", "60"))  # Reciprocal rank fusion constant
+answer_cache_threshold = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97"))  # Min cosine similarity to reuse an answer
+answer_cache_ttl = float(os.getenv("ANSWER_CACHE_TTL", "3600"))  # Seconds a cached answer stays valid
+answer_cache_max_entries = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+stream_responses = os.getenv("STREAM_RESPONSES", "true").lower() == "true"  # Emit answer tokens as message_chunk events
+query_max_workers = int(os.getenv("QUERY_MAX_WORKERS", "16"))  # Threads for retrieval and cache lookups of chat queries
+llm_max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # Answers generated by the LLM at once
+query_queue_depth = int(os.getenv("QUERY_QUEUE_DEPTH", "64"))  # Queries queued or running before new ones get "busy"
+session_queue_depth = int(os.getenv("SESSION_QUEUE_DEPTH", "2"))  # Queries a session may queue behind its running one
+query_batch_window_ms = float(os.getenv("QUERY_BATCH_WINDOW_MS", "5"))  # Wait to batch query embeddings/searches (0 = off)
+query_batch_max_size = int(os.getenv("QUERY_BATCH_MAX_SIZE", "32"))  # Queries served by one batched embedding call
+query_poll_interval = 0.02  # Seconds between checks on work running in the thread pools
+page_cache_directory = os.getenv("PAGE_CACHE_DIR", "./page_cache")
+page_cache_memory_bytes = int(os.getenv("PAGE_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+page_cache_disk_bytes = int(os.getenv("PAGE_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+page_zoom_levels = (0.2, 0.5, 1.0, 1.5, 2.0, 3.0)  # Allowed render zooms, so the cache stays bounded
+page_image_formats = {"png": "image/png", "webp": "image/webp"}
+thumbnail_zoom = 0.2
+thumbnail_page_size = 20  # Default thumbnails per /pdf/thumbnails request
+prerender_thumbnails_enabled = os.getenv("PRERENDER_THUMBNAILS", "true").lower() == "true"
+pdf_handle_pool_size = int(os.getenv("PDF_HANDLE_POOL_SIZE", "4"))  # Open PyMuPDF handles per document for concurrent renders
+pdf_handle_timeout = float(os.getenv("PDF_HANDLE_TIMEOUT", "30"))  # Seconds to wait for a free handle before giving up
+trace_slow_ms = float(os.getenv("TRACE_SLOW_MS", "2000"))  # Queries slower than this are kept for /admin/traces
+trace_buffer_size = int(os.getenv("TRACE_BUFFER_SIZE", "100"))  # Recent and slow traces kept in memory
+admin_token = os.getenv("ADMIN_TOKEN")  # Enables the /admin endpoints (sent as the X-Admin-Token header)
+profile_directory = os.getenv("PROFILE_DIR", "./profiles")  # Where profiles requested via /admin/profile are written
+profile_ingestion = os.getenv("PROFILE_INGESTION", "false").lower() == "true"  # Stack-sample the start-up ingestion
+index_snapshot_path = os.getenv("INDEX_SNAPSHOT")  # Snapshot restored at start-up instead of ingesting (see build-snapshot)
+snapshot_restore_batch_size = 5000  # Rows upserted per call when restoring a snapshot (Chroma caps batch sizes)
+profile_sample_interval = 0.005  # Seconds between stack samples during a query or ingestion profile
 
-# Initialize LangChain components
-embeddings = OpenAIEmbeddings(api_key=api_key, base_url=base_url, model="text-embedding-ada-002")
-llm = ChatOpenAI(api_key=api_key, base_url=base_url, model="gpt-3.5-turbo", temperature=0.2)
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text exposition format.
 
-def extract_text_from_pdf(pdf_path):
-    """Extract text from a PDF file, using OCR for image-based pages if available."""
-    pdf_path = Path(pdf_path)
-    if not pdf_path.exists():
-        logger.error(f"PDF file not found: {pdf_path}")
+    Each update is one dict lookup and a few additions under a lock, so instrumenting hot paths
+    costs microseconds. Values other components already count (cache hits, queue depth) are read
+    by collectors at scrape time instead of being recorded as they change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}  # name -> (type, help, buckets)
+        self._values = {}  # (name, labels) -> counter/gauge value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+        self._collectors = []  # Callables returning [(name, labels dict, value)] at scrape time
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._families[name] = (kind, help_text, tuple(buckets) if buckets else None)
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter or gauge (pass a negative value to decrease a gauge)."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self._families[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 2)
+            series[bisect_left(buckets, value)] += 1  # Index len(buckets) is the +Inf bucket
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe the duration of the with block in seconds, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        """Decorator form of time()."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def in_progress(self, name, **labels):
+        """Count the with block in a gauge while it runs."""
+        self.inc(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.inc(name, -1, **labels)
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: list(series) for key, series in self._histograms.items()}
+        for collect in self._collectors:
+            try:
+                for name, labels, value in collect():
+                    values[(name, tuple(sorted(labels.items())))] = value
+            except Exception as e:
+                logger.warning(f"Metrics collector {collect.__name__} failed: {e}")
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self._families.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (series_name, labels), series in sorted(histograms.items()):
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + (float("inf"),), series):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(float(bound))
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {series[-2]}")
+                    lines.append(f"{name}_count{format_labels(labels)} {series[-1]}")
+            else:
+                for (series_name, labels), value in sorted(values.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
         return ""
+    escaped = (
+        f'{key}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token for English), used without tiktoken."""
+    return max(1, len(text) // 4) if text else 0
+
+duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+metrics = Metrics()
+metrics.describe("exam_stage_duration_seconds", "histogram", "Time spent per pipeline stage.", duration_buckets)
+metrics.describe("exam_http_request_duration_seconds", "histogram", "HTTP request latency by route.", duration_buckets)
+metrics.describe("exam_http_requests_total", "counter", "HTTP requests by route and status.")
+metrics.describe("exam_http_requests_in_flight", "gauge", "HTTP requests being handled, by route.")
+metrics.describe("exam_llm_requests_in_flight", "gauge", "LLM calls in progress, by operation.")
+metrics.describe("exam_llm_tokens", "histogram", "Tokens per LLM call, by operation and kind.",
+                 (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192))
+metrics.describe("exam_llm_tokens_total", "counter", "LLM tokens, by operation and kind.")
+metrics.describe("exam_embedding_texts_total", "counter", "Texts sent to the embedding model.")
+metrics.describe("exam_query_batch_size", "histogram", "Queries served per batched embedding call.", (1, 2, 4, 8, 16, 32, 64))
+metrics.describe("exam_connected_sessions", "gauge", "Connected Socket.IO sessions.")
+metrics.describe("exam_cache_hits_total", "counter", "Cache hits, by cache.")
+metrics.describe("exam_cache_misses_total", "counter", "Cache misses, by cache.")
+metrics.describe("exam_cache_hit_ratio", "gauge", "Share of cache lookups that hit, by cache.")
+metrics.describe("exam_queries_pending", "gauge", "Chat queries queued or running.")
+metrics.describe("exam_index_ready", "gauge", "1 once the index can answer queries.")
+
+class Trace:
+    """Spans of one request, each stored as (name, offset from the trace start, duration) in seconds."""
+
+    def __init__(self, request_id, name, attributes, start=None):
+        self.request_id = request_id
+        self.name = name
+        self.attributes = attributes
+        self._start = time.perf_counter() if start is None else start
+        self.started_at = time.time() - (time.perf_counter() - self._start)
+        self.spans = []  # Appended from worker threads; list.append is atomic
+        self.duration = None
+
+    def add_span(self, name, start, duration):
+        self.spans.append((name, start - self._start, duration))
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "name": self.name,
+            "attributes": self.attributes,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "spans": [
+                {"name": name, "start_ms": round(offset * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+                for name, offset, duration in sorted(self.spans, key=lambda span: span[1])
+            ]
+        }
+
+class Tracer:
+    """Keeps the last buffer_size finished traces, and separately the last buffer_size slow ones."""
+
+    def __init__(self, slow_threshold, buffer_size):
+        self.slow_threshold = slow_threshold
+        self.recent = deque(maxlen=buffer_size)
+        self.slow = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+
+    def start(self, name, start=None, **attributes):
+        return Trace(uuid.uuid4().hex[:16], name, attributes, start)
+
+    def finish(self, trace):
+        trace.finish()
+        with self._lock:
+            self.recent.append(trace)
+            if trace.duration >= self.slow_threshold:
+                self.slow.append(trace)
+
+    def find(self, request_id):
+        """A kept trace by request ID, including slow ones already pushed out of recent."""
+        with self._lock:
+            traces = itertools.chain(reversed(self.recent), reversed(self.slow))
+            return next((trace for trace in traces if trace.request_id == request_id), None)
+
+    def slowest(self, limit):
+        with self._lock:
+            traces = list(self.slow)
+        return sorted(traces, key=lambda trace: trace.duration, reverse=True)[:limit]
+
+tracer = Tracer(trace_slow_ms / 1000, trace_buffer_size)
+current_trace = contextvars.ContextVar("current_trace", default=None)  # Trace of the request being handled
+
+def record_stage(name, start, duration):
+    metrics.observe("exam_stage_duration_seconds", duration, stage=name)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(name, start, duration)
+
+@contextmanager
+def stage(name):
+    """Time a pipeline stage into the stage histogram and, if there is one, the current trace."""
+    start = time.perf_counter()
     try:
-        pdf = fitz.open(pdf_path)
-        text = ""
-        image_page_count = 0
-        total_pages = len(pdf)
+        yield
+    finally:
+        record_stage(name, start, time.perf_counter() - start)
 
-        for page_num in range(total_pages):
+def staged(name):
+    """Decorator form of stage()."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def submit_in_context(executor, fn, *args):
+    """executor.submit, running fn with the caller's context variables (such as the current trace)."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+class ProfileCapture:
+    """Stack samples of every thread while it does part of one request's work, merged into one file.
+
+    Sampled rather than traced with cProfile: Python 3.12+ allows one active cProfile profiler per
+    process, and a request's work runs in several threads, alongside other profiled requests.
+    """
+
+    def __init__(self, label, interval):
+        self.label = label
+        self._threads = {}  # Thread id -> calls of run() in progress on it
+        self._lock = threading.Lock()
+        self._sampler = StackSampler(interval, threads=self._threads)
+        self._sampler.start()
+
+    def run(self, fn, *args, **kwargs):
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._threads[thread_id] = self._threads.get(thread_id, 0) + 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._threads[thread_id] -= 1
+                if not self._threads[thread_id]:
+                    del self._threads[thread_id]
+
+    def dump(self, directory):
+        """Stop sampling and write the samples as a folded file; returns its path, or None without samples."""
+        self._sampler.stop()
+        if not self._sampler.counts:
+            return None
+        return self._sampler.dump(os.path.join(directory, f"{self.label}.folded"))
+
+class StackSampler:
+    """Samples thread stacks every interval seconds, counting identical stacks.
+
+    All threads are sampled, or only those whose ids are in threads, which may change meanwhile.
+    Results are written in the folded format (frame;frame;frame count) read by flame graph tools.
+    """
+
+    def __init__(self, interval, threads=None):
+        self.interval = interval
+        self.threads = threads  # Container of the thread ids to sample, or None for every thread
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True, name="stack-sampler")
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or (self.threads is not None and thread_id not in self.threads):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+        return path
+
+class Profiler:
+    """Profiling switched on at runtime: stack sampling for the next N chat queries or for ingestion."""
+
+    def __init__(self, directory, sample_interval):
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.remaining_queries = 0
+        self.ingestion_running = False
+        self._lock = threading.Lock()
+
+    def profile_queries(self, count):
+        with self._lock:
+            self.remaining_queries = count
+
+    def query_capture(self, request_id):
+        """A ProfileCapture for this query if profiling was requested, else None."""
+        with self._lock:
+            if self.remaining_queries <= 0:
+                return None
+            self.remaining_queries -= 1
+        return ProfileCapture(f"query-{request_id}", self.sample_interval)
+
+    def run_ingestion(self, fn):
+        """Run fn while sampling all threads' stacks, then write the samples to the profile directory."""
+        sampler = StackSampler(self.sample_interval)
+        self.ingestion_running = True
+        sampler.start()
+        try:
+            return fn()
+        finally:
+            sampler.stop()
+            self.ingestion_running = False
+            path = sampler.dump(os.path.join(self.directory, f"ingestion-{time.strftime('%Y%m%d-%H%M%S')}.folded"))
+            logger.info(f"Wrote ingestion profile ({sum(sampler.counts.values())} samples) to {path}")
+
+    def files(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.listdir(self.directory))
+
+profiler = Profiler(profile_directory, profile_sample_interval)
+
+def record_tokens(operation, prompt_tokens, completion):
+    for kind, tokens in (("prompt", prompt_tokens), ("completion", count_tokens(completion))):
+        metrics.observe("exam_llm_tokens", tokens, operation=operation, kind=kind)
+        metrics.inc("exam_llm_tokens_total", tokens, operation=operation, kind=kind)
+
+class CachedEmbeddings:
+    """Embeddings wrapper that caches vectors on disk in SQLite as float32 blobs.
+
+    Entries are keyed by (model name, hash of whitespace-normalized text). A small in-memory
+    LRU sits in front of SQLite, and the on-disk table is trimmed to max_entries by last use.
+    It implements LangChain's Embeddings interface; the wrapped model is built by
+    underlying_factory on first use.
+    """
+
+    def __init__(self, underlying_factory, model_name, path, max_entries=200000, memory_entries=10000):
+        self._underlying_factory = underlying_factory
+        self._underlying = None
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @property
+    def underlying(self):
+        with self._lock:
+            if self._underlying is None:
+                self._underlying = self._underlying_factory()
+            return self._underlying
+
+    def _key(self, text):
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{self.model_name}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys):
+        """Return {key: vector} for cached keys, checking memory first and then SQLite."""
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                else:
+                    missing.append(key)
+            now = time.time()
+            for start in range(0, len(missing), 500):
+                batch = missing[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+                    self._remember(key, found[key])
+                if rows:
+                    self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, _ in rows])
+            self._conn.commit()
+        return found
+
+    def _store(self, items):
+        """Persist (key, vector) pairs and evict the least recently used rows past max_entries.
+
+        Returns the vectors rounded to float32, so callers see the same values a later cache hit returns.
+        """
+        now = time.time()
+        packed = [(key, array("f", vector)) for key, vector in items]
+        stored = {key: vector.tolist() for key, vector in packed}
+        with self._lock:
+            for key, vector in stored.items():
+                self._remember(key, vector)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(key, self.model_name, vector.tobytes(), now) for key, vector in packed]
+            )
+            self._count += len(items)
+            if self._count > self.max_entries:
+                self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                excess = self._count - int(self.max_entries * 0.9)
+                if excess > 0:
+                    self._conn.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                        (excess,)
+                    )
+                    self._count -= excess
+                    logger.info(f"Embedding cache evicted {excess} least recently used entries")
+            self._conn.commit()
+        return stored
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(list(dict.fromkeys(keys)))
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        self.hits += len(texts) - sum(1 for key in keys if key not in found)
+        self.misses += len(missing)
+        if missing:
+            texts_by_key = dict(zip(keys, texts))
+            metrics.inc("exam_embedding_texts_total", len(missing))
+            with stage("embedding"):
+                vectors = self.underlying.embed_documents([texts_by_key[key] for key in missing])
+            found.update(self._store(list(zip(missing, vectors))))
+        return [found[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self._key(text)
+        found = self._lookup([key])
+        if key in found:
+            self.hits += 1
+            return found[key]
+        self.misses += 1
+        metrics.inc("exam_embedding_texts_total")
+        with stage("embedding"):
+            vector = self.underlying.embed_query(text)
+        return self._store([(key, vector)])[key]
+
+def openai_options():
+    """Connection settings for the OpenAI clients."""
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY not set.")
+    return {"api_key": api_key, "base_url": base_url}
+
+def create_embedding_model():
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(model=embedding_model, **openai_options())
+
+# Initialize LangChain components; the OpenAI clients are created on first use
+embeddings = CachedEmbeddings(
+    create_embedding_model,
+    model_name=embedding_model,
+    path=embedding_cache_path,
+    max_entries=embedding_cache_max_entries,
+    memory_entries=embedding_cache_memory_entries
+)
+llm = None  # Created by chat_model()
+_llm_lock = threading.Lock()
+
+def chat_model():
+    """The chat model, created on first use."""
+    global llm
+    with _llm_lock:
+        if llm is None:
+            from langchain_openai import ChatOpenAI
+            llm = ChatOpenAI(model="gpt-3.5-turbo", temperature=0.2, **openai_options())
+        return llm
+
+class OcrCache:
+    """SQLite cache of OCR output keyed by a hash of the image bytes and the Tesseract config."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS ocr (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(image_data, config):
+        return hashlib.sha256(config.encode("utf-8") + b"\0" + image_data).hexdigest()
+
+    def get(self, keys):
+        """Return {key: text} for the keys that are cached."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                found.update(self._conn.execute(
+                    f"SELECT key, text FROM ocr WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall())
+        return found
+
+    def put(self, key, text):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO ocr (key, text) VALUES (?, ?)", (key, text))
+            self._conn.commit()
+
+ocr_cache = OcrCache(ocr_cache_path)
+
+def plan_page_ocr(pdf, page):
+    """Return the (cache key, tesseract config, load) jobs needed to OCR an image-only page.
+
+    A single embedded image with enough resolution is OCR'd as-is. Tiled scans (several images
+    on one page) and low-resolution images are OCR'd from one render of the page at ocr_render_dpi,
+    so Tesseract sees the whole page at a resolution it reads well. Keys hash the raw image
+    streams, and load() extracts or renders the image bytes only when the cache misses.
+    """
+    infos = [info for info in page.get_image_info(xrefs=True) if info.get("xref")]
+    if len(infos) == 1:
+        info = infos[0]
+        bbox_width_inches = (info["bbox"][2] - info["bbox"][0]) / 72
+        effective_dpi = info["width"] / bbox_width_inches if bbox_width_inches > 0 else 0
+        if effective_dpi >= ocr_min_image_dpi:
+            xref = info["xref"]
+            config = f"{ocr_config} --dpi {int(effective_dpi)}"
+            return [(OcrCache.key(pdf.xref_stream_raw(xref), config), config, lambda: pdf.extract_image(xref)["image"])]
+    config = f"{ocr_config} --dpi {ocr_render_dpi}"
+    page_data = page.read_contents() + b"".join(pdf.xref_stream_raw(info["xref"]) for info in infos)
+    return [(OcrCache.key(page_data, config), config, lambda: page.get_pixmap(dpi=ocr_render_dpi).tobytes("png"))]
+
+def ocr_pages(ocr_jobs, executor_factory):
+    """OCR the planned jobs of image-only pages, returning {page_num: text}.
+
+    Cached results are reused; misses run in the process pool returned by executor_factory().
+    """
+    ocr_texts = ocr_cache.get([key for jobs in ocr_jobs.values() for key, _, _ in jobs])
+    page_seconds = {page_num: 0.0 for page_num in ocr_jobs}
+    pending = {
+        key: (page_num, load(), config)
+        for page_num, jobs in ocr_jobs.items()
+        for key, config, load in jobs if key not in ocr_texts
+    }
+    logger.info(f"OCR: {len(ocr_jobs)} image-based pages, {len(ocr_texts)} images cached, {len(pending)} to process")
+    if pending:
+        executor = executor_factory()
+        futures = {
+            executor.submit(ocr_image, image_bytes, config): key
+            for key, (page_num, image_bytes, config) in pending.items()
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            page_num = pending[key][0]
+            try:
+                ocr_texts[key], seconds = future.result()
+            except Exception as e:
+                logger.error(f"Page {page_num + 1}: OCR failed: {e}")
+                if isinstance(e, BrokenProcessPool):
+                    discard_ocr_executor(executor)
+                continue
+            page_seconds[page_num] += seconds
+            ocr_cache.put(key, ocr_texts[key])
+    page_texts = {}
+    for page_num, jobs in sorted(ocr_jobs.items()):
+        page_texts[page_num] = "\n".join(ocr_texts[key] for key, _, _ in jobs if ocr_texts.get(key))
+        source = "cached" if all(key not in pending for key, _, _ in jobs) else f"{page_seconds[page_num]:.2f}s"
+        if page_texts[page_num]:
+            logger.info(f"Page {page_num + 1}: OCR extracted {len(page_texts[page_num])} characters ({source})")
+        else:
+            logger.warning(f"Page {page_num + 1}: OCR found no text ({source})")
+    return page_texts
+
+_ocr_executors = {}  # max_workers -> ProcessPoolExecutor shared by every ingestion
+_ocr_executors_lock = threading.Lock()
+
+def ocr_executor(max_workers):
+    """The OCR process pool with max_workers processes, started on first use.
+
+    Workers are spawned, not forked: a fork of this multi-threaded server could inherit locks
+    (logging, SQLite, thread pools) held by other threads and deadlock.
+    """
+    with _ocr_executors_lock:
+        executor = _ocr_executors.get(max_workers)
+        if executor is None:
+            executor = _ocr_executors[max_workers] = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return executor
+
+def discard_ocr_executor(executor):
+    """Drop a pool whose worker died, so the next ingestion starts a new one."""
+    with _ocr_executors_lock:
+        for max_workers, pool in list(_ocr_executors.items()):
+            if pool is executor:
+                del _ocr_executors[max_workers]
+    executor.shutdown(wait=False, cancel_futures=True)
+
+@atexit.register
+def shutdown_ocr_executors():
+    with _ocr_executors_lock:
+        executors = list(_ocr_executors.values())
+        _ocr_executors.clear()
+    for executor in executors:
+        executor.shutdown(cancel_futures=True)
+
+def iter_pdf_pages(pdf_path, max_workers=None):
+    """Yield (page_num, text) for each page of a PDF that has text, in page order.
+
+    Image-only pages are OCR'd in the shared process pool of max_workers (OCR_MAX_WORKERS), and
+    results are cached by image hash so re-ingesting an unchanged scan does not OCR it again. Pages
+    are buffered only while a window of OCR pages is in flight, so memory does not grow with the PDF.
+    """
+    max_workers = ocr_max_workers if max_workers is None else max_workers
+    window = max(1, max_workers * 2)
+    pdf = fitz.open(pdf_path)
+    buffered = []  # (page_num, text) in page order; OCR pages get their text on flush
+    ocr_jobs = {}  # page_num -> [(cache key, tesseract config, load image bytes)]
+    image_page_count = 0
+
+    def flush():
+        ocr_texts = ocr_pages(ocr_jobs, lambda: ocr_executor(max_workers)) if ocr_jobs else {}
+        for page_num, page_text in buffered:
+            page_text = ocr_texts.get(page_num, page_text)
+            if page_text:
+                yield page_num, page_text
+        buffered.clear()
+        ocr_jobs.clear()
+
+    try:
+        for page_num in range(len(pdf)):
             page = pdf[page_num]
             page_text = page.get_text("text").strip()
             if page_text:
-                text += page_text + "\n"
                 logger.info(f"Page {page_num + 1}: Extracted {len(page_text)} characters (text-based)")
             elif OCR_AVAILABLE:
-                images = page.get_images(full=True)
-                if images:
-                    logger.info(f"Page {page_num + 1}: No text found. Attempting OCR on {len(images)} images.")
-                    for img_index, img in enumerate(images):
-                        xref = img[0]
-                        base_image = pdf.extract_image(xref)
-                        image_bytes = base_image["image"]
-                        image = Image.open(BytesIO(image_bytes))
-                        try:
-                            ocr_text = pytesseract.image_to_string(
-                                image, lang='eng', config='--psm 6 --dpi 300'
-                            ).strip()
-                            if ocr_text:
-                                text += ocr_text + "\n"
-                                logger.info(f"Page {page_num + 1}, Image {img_index + 1}: OCR extracted {len(ocr_text)} characters")
-                            else:
-                                logger.warning(f"Page {page_num + 1}, Image {img_index + 1}: OCR found no text")
-                        except Exception as e:
-                            logger.error(f"Page {page_num + 1}, Image {img_index + 1}: OCR failed: {e}")
+                if page.get_images(full=True):
+                    ocr_jobs[page_num] = plan_page_ocr(pdf, page)
                     image_page_count += 1
                 else:
                     logger.warning(f"Page {page_num + 1}: No text or images found.")
             else:
                 logger.warning(f"Page {page_num + 1}: No text found and OCR not available.")
-
+            buffered.append((page_num, page_text))
+            if not ocr_jobs or len(ocr_jobs) >= window:
+                yield from flush()
+        yield from flush()
+        logger.info(f"Read {len(pdf)} pages from {pdf_path}. Image-based pages: {image_page_count}/{len(pdf)}")
+    finally:
         pdf.close()
+
+def extract_text_from_pdf(pdf_path, max_workers=None):
+    """Extract text from a PDF file, using OCR for image-based pages if available."""
+    pdf_path = Path(pdf_path)
+    if not pdf_path.exists():
+        logger.error(f"PDF file not found: {pdf_path}")
+        return ""
+    try:
+        text = "".join(page_text + "\n" for _, page_text in iter_pdf_pages(pdf_path, max_workers))
         if not text.strip():
             logger.error("No text extracted from PDF. Ensure pytesseract and Pillow are installed for OCR support.")
             return ""
-        logger.info(f"Extracted {len(text)} characters from {pdf_path}. Image-based pages: {image_page_count}/{total_pages}")
+        logger.info(f"Extracted {len(text)} characters from {pdf_path}")
         return text
     except Exception as e:
         logger.error(f"Error extracting PDF {pdf_path}: {e}")
         return ""
 
+def iter_chunks(pages, chunk_size, chunk_overlap, window_chunks=16):
+    """Split a stream of (page_num, text) pages into (chunk, first page, last page) tuples.
+
+    Text is split between lines, since PyMuPDF separates lines but not paragraphs with newlines.
+    The whole document is never built: text is buffered until it spans about window_chunks chunks,
+    then split up to its last separator (so no line is cut at the window edge). The last chunk
+    is carried into the next window together with the unsplit tail, so the output matches splitting
+    the full text at once (up to whitespace the splitter strips at window edges). Page numbers come
+    from locating each chunk's first and last line in the buffered text.
+    """
+    from langchain.text_splitter import CharacterTextSplitter
+
+    text_splitter = CharacterTextSplitter(separator="\n", chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    separator = text_splitter._separator
+    buffer = ""
+    page_offsets = []  # Offset in buffer where each buffered page starts
+    page_nums = []
+    cursor = 0  # Chunks come in document order, so each is searched for after the previous one starts
+
+    def page_at(offset):
+        return page_nums[max(0, bisect_right(page_offsets, offset) - 1)]
+
+    def locate(chunk):
+        nonlocal cursor
+        first, last = chunk.split(separator, 1)[0], chunk.rsplit(separator, 1)[-1]
+        start = buffer.find(first, cursor)
+        start = cursor if start < 0 else start
+        end = buffer.find(last, start)
+        end = start + len(chunk) if end < 0 else end + len(last)
+        cursor = start + 1
+        return start, end
+
+    for page_num, page_text in pages:
+        page_offsets.append(len(buffer))
+        page_nums.append(page_num)
+        buffer += page_text + "\n"
+        if len(buffer) >= chunk_size * window_chunks:
+            cut = buffer.rfind(separator)
+            chunks = text_splitter.split_text(buffer[:cut]) if cut > 0 else []
+            if len(chunks) > 1:
+                for chunk in chunks[:-1]:
+                    start, end = locate(chunk)
+                    yield chunk, page_at(start), page_at(end - 1)
+                carry_start, _ = locate(chunks[-1])
+                carried = [(0, page_at(carry_start))]
+                for offset, num in zip(page_offsets, page_nums):
+                    if carry_start < offset < cut:
+                        carried.append((min(offset - carry_start, len(chunks[-1])), num))
+                    elif offset >= cut:
+                        carried.append((offset - cut + len(chunks[-1]), num))
+                page_offsets = [offset for offset, _ in carried]
+                page_nums = [num for _, num in carried]
+                buffer = chunks[-1] + buffer[cut:]
+                cursor = 0
+    if buffer.strip():
+        for chunk in text_splitter.split_text(buffer):
+            start, end = locate(chunk)
+            yield chunk, page_at(start), page_at(end - 1)
+
+section_separator = " > "  # Joins the TOC titles of a chunk's section path in its metadata
+chunker_version = 2  # Bumped when chunk boundaries change, so process_document re-indexes
+
+def find_heading(text, title, start=0):
+    """Offset of the line where a TOC title appears in page text (at or after start), or -1."""
+    pattern = r"\s+".join(re.escape(word) for word in title.split())
+    match = re.compile(pattern, re.IGNORECASE).search(text, start)
+    if not match:
+        return -1
+    return max(start, text.rfind("\n", 0, match.start()) + 1)
+
+def iter_sections(pages, toc):
+    """Split a stream of (page_num, text) pages where the TOC's sections start.
+
+    Yields (section path, page_num, text) in document order, where the section path is the tuple
+    of TOC titles from the top level down to the section. A section starts at the line holding its
+    heading on its TOC page, or with that page if the heading isn't found there.
+    """
+    entries = [(level, " ".join(title.split()), page - 1) for level, title, page in toc if page >= 1 and title.strip()]
+    next_entry = 0
+    path = ()
+    for page_num, text in pages:
+        offset = 0
+        # Sections starting on pages without text begin before this page
+        while next_entry < len(entries) and entries[next_entry][2] <= page_num:
+            level, title, page = entries[next_entry]
+            next_entry += 1
+            start = find_heading(text, title, offset) if page == page_num else -1
+            if start > offset:
+                if text[offset:start].strip():
+                    yield path, page_num, text[offset:start]
+                offset = start
+            path = path[:level - 1] + (title,)
+        if text[offset:].strip():
+            yield path, page_num, text[offset:]
+
+def iter_section_chunks(pages, toc, chunk_size, chunk_overlap):
+    """Split pages into (chunk, first page, last page, section path) tuples; no chunk crosses a TOC section start.
+
+    Without a TOC the whole document is one section with an empty path.
+    """
+    for path, segments in itertools.groupby(iter_sections(pages, toc), key=lambda segment: segment[0]):
+        section_pages = ((page_num, text) for _, page_num, text in segments)
+        for chunk, first_page, last_page in iter_chunks(section_pages, chunk_size, chunk_overlap):
+            yield chunk, first_page, last_page, path
+
+_section_numbering = re.compile(r"^(\d+(?:\.\d+)*\.?|[IVXLC]+\.|[A-Z]\.)\s+")
+
+def section_key(title):
+    """A heading without its numbering ("3.2 Re-evaluation" -> "re-evaluation"), for matching section names."""
+    return _section_numbering.sub("", title.strip()).lower()
+
+def section_number(title):
+    """The numbering of a heading without a final dot ("3.2. Re-evaluation" -> "3.2"), or None."""
+    match = _section_numbering.match(title.strip())
+    return match.group(1).rstrip(".") if match else None
+
+def build_section_index(chunk_map):
+    """{section path: [chunk_id]} for the chunks of a document."""
+    sections = {}
+    for chunk_id, chunk in chunk_map.items():
+        sections.setdefault(chunk["metadata"].get("section", ""), []).append(chunk_id)
+    return sections
+
+def find_sections(section_index, section):
+    """The entries of a section index within section, given as a path ("A > B") or a heading of any level.
+
+    A numbered heading ("5. Attendance") matches only the section with that number; without
+    numbering ("Attendance") it matches every section of that title. Both include their subsections.
+    """
+    wanted = section.strip().lower()
+    key, number = section_key(section), section_number(section)
+
+    def heading_matches(title):
+        return section_key(title) == key and (number is None or section_number(title) == number)
+
+    return {
+        path: chunk_ids for path, chunk_ids in section_index.items()
+        if path and (path.lower() == wanted or path.lower().startswith(wanted + section_separator)
+                     or any(heading_matches(title) for title in path.split(section_separator)))
+    }
+
+def call_with_retry(fn, description, max_retries=None):
+    """Call fn(), retrying with exponential backoff on rate-limit and transient API errors."""
+    from openai import RateLimitError, APITimeoutError, APIConnectionError
+
+    max_retries = api_max_retries if max_retries is None else max_retries
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except (RateLimitError, APITimeoutError, APIConnectionError) as e:
+            if attempt >= max_retries:
+                raise
+            delay = min(30, 2 ** attempt) + random.uniform(0, 1)
+            logger.warning(f"{description}: {type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{max_retries})")
+            time.sleep(delay)
+
+_token_encoder = None
+_token_encoder_lock = threading.Lock()
+
+def token_encoder():
+    """tiktoken encoding for tokenizer_model, loaded once; None if tiktoken or its encoding file is unavailable."""
+    global _token_encoder
+    if _token_encoder is None:
+        with _token_encoder_lock:
+            if _token_encoder is None:
+                try:
+                    import tiktoken
+                    _token_encoder = tiktoken.encoding_for_model(tokenizer_model)
+                except Exception as e:
+                    logger.warning(f"tiktoken unavailable ({e}), estimating prompt tokens from text length")
+                    _token_encoder = False
+    return _token_encoder or None
+
+def count_tokens(text):
+    """Tokens in text for the chat model (estimated when tiktoken is unavailable)."""
+    if not text:
+        return 0
+    encoder = token_encoder()
+    return len(encoder.encode_ordinary(text)) if encoder else estimate_tokens(text)
+
+def truncate_tokens(text, limit):
+    """text cut to at most limit tokens, at a word boundary where possible."""
+    encoder = token_encoder()
+    if encoder:
+        tokens = encoder.encode_ordinary(text)
+        if len(tokens) <= limit:
+            return text
+        cut = encoder.decode(tokens[:max(0, limit)])
+    else:
+        if len(text) <= limit * 4:
+            return text
+        cut = text[:max(0, limit) * 4]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > len(cut) // 2 else cut).rstrip() + "..."
+
+answer_template = (
+    "You are a chatbot assisting with Bennett University's Examination Manual. "
+    "Your goal is to provide accurate, helpful information while maintaining proper context throughout the conversation.\n\n"
+    "INSTRUCTIONS:\n"
+    "1. Use the conversation history to understand the context of the current question\n"
+    "2. Reference the provided context from the manual to answer accurately\n"
+    "3. Maintain continuity with previous exchanges\n"
+    "4. If the question relates to previous questions, acknowledge that relationship\n"
+    "5. If information is missing from the context, clearly state that you don't have that specific information\n"
+    "6. Always cite the relevant section from the manual when possible\n"
+    "7. Be concise but complete in your response\n\n"
+    "{history}\n\n"
+    "CONTEXT FROM EXAMINATION MANUAL:\n{context}\n\n"
+    "CURRENT QUESTION: {question}\n\n"
+    "RESPONSE:"
+)
+summary_template = "Summarize the following text in 2-3 sentences, capturing key points:\n\n{text}\n\nSummary:"
+summary_input_chars = 4000  # Chunk text sent for a summary, to stay well under the model's context
+failed_summary_placeholder = "Summary unavailable."  # Stored by earlier versions when summarization failed
+
+@functools.lru_cache(maxsize=None)
+def compiled_prompt(template):
+    """PromptTemplate for template, built once per process."""
+    from langchain.prompts import PromptTemplate
+
+    return PromptTemplate.from_template(template)
+
+@functools.lru_cache(maxsize=None)
+def static_prompt_tokens(template):
+    """Tokens in template itself, without its variables. Cached, so only call once the tokenizer has loaded."""
+    prompt = compiled_prompt(template)
+    return count_tokens(prompt.format(**{name: "" for name in prompt.input_variables}))
+
+@staged("summary")
 def generate_summary(text, chunk_index):
-    """Generate a summary for a chunk of text."""
-    prompt = PromptTemplate(
-        input_variables=["text"],
-        template="Summarize the following text in 2-3 sentences, capturing key points:\n\n{text}\n\nSummary:"
-    )
+    """Generate a summary for a chunk of text, or None if the LLM call failed."""
+    prompt = compiled_prompt(summary_template)
     try:
         logger.info(f"Generating summary for chunk {chunk_index}")
-        chain = prompt | llm
-        summary = chain.invoke({"text": text[:4000]}).content.strip()  # Limit input to avoid token limits
+        chain = prompt | chat_model()
+        with metrics.in_progress("exam_llm_requests_in_flight", operation="summary"):
+            summary = call_with_retry(
+                lambda: chain.invoke({"text": text[:summary_input_chars]}),
+                f"Summary for chunk {chunk_index}"
+            ).content.strip()
+        record_tokens("summary", static_prompt_tokens(summary_template) + count_tokens(text[:summary_input_chars]), summary)
         logger.debug(f"Generated summary for chunk {chunk_index}: {summary[:100]}...")
         return summary
     except Exception as e:
         logger.error(f"Error generating summary for chunk {chunk_index}: {e}")
-        return "Summary unavailable."
+        return None
+
+def ordered_map(fn, items, max_workers):
+    """Yield fn(item) for each item in order, running up to max_workers calls concurrently.
+
+    Items are pulled from the iterable only as results are consumed, so a slow consumer
+    applies backpressure instead of letting results pile up in memory.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for item in items:
+            in_flight.append(executor.submit(fn, item))
+            if len(in_flight) >= max_workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def batched(items, size):
+    """Yield lists of up to size items from an iterable."""
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def embed_texts(texts, batch_size=None, max_workers=None):
+    """Embed texts in batches, sending up to max_workers batch requests concurrently."""
+    batch_size = batch_size or embedding_batch_size
+    max_workers = max_workers or embedding_max_workers
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    vectors = [None] * len(batches)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(call_with_retry, lambda batch=batch: embeddings.embed_documents(batch), f"Embedding batch {i}"): i
+            for i, batch in enumerate(batches)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            vectors[i] = future.result()
+            logger.info(f"Embedded batch {i + 1}/{len(batches)} ({len(batches[i])} texts)")
+    return [vector for batch in vectors for vector in batch]
 
-def process_document(pdf_path, chunk_size=800, chunk_overlap=200):
-    """Process PDF and store in Chroma vector stores for summaries and chunks."""
-    # Check if Chroma DB already exists
-    if os.path.exists(persist_directory) and os.listdir(persist_directory):
-        logger.info(f"Found existing Chroma database at {persist_directory}. Attempting to load...")
+def matches_where(metadata, where):
+    """Evaluate a Chroma-style metadata filter ({"field": value}, {"field": {"$eq"/"$ne"/"$in"/"$nin": ...}}, "$and", "$or")."""
+    if not where:
+        return True
+    for field, condition in where.items():
+        if field == "$and":
+            if not all(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif field == "$or":
+            if not any(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(field)
+            for op, operand in condition.items():
+                if (op == "$eq" and value != operand) or (op == "$ne" and value == operand) \
+                        or (op == "$in" and value not in operand) or (op == "$nin" and value in operand):
+                    return False
+        elif metadata.get(field) != condition:
+            return False
+    return True
+
+class NumpyVectorStore:
+    """Exact-search vector store backed by one contiguous, memory-mapped matrix.
+
+    Vectors are L2-normalized on insert, so cosine similarity is a single matrix-vector product.
+    They are stored as float32, float16 or int8 (with a per-row scale) in vectors.npy, alongside
+    ids, documents and metadatas in meta.json. It implements the subset of the Chroma collection
+    API (count/get/upsert/update/delete) and of the LangChain store API used by this app, and exposes
+    itself as _collection so process_document works with either backend.
+
+    Writes go to an in-memory matrix with spare rows, so upserts append in place, and are persisted
+    by flush(): process_document flushes once per document, and a write flushes by itself once
+    NUMPY_FLUSH_ROWS rows have changed since the last one.
+    """
+
+    def __init__(self, collection_name, embedding_function, persist_directory, dtype="float32"):
+        if dtype not in ("float32", "float16", "int8"):
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        self.collection_name = collection_name
+        self.embedding_function = embedding_function
+        self.directory = os.path.join(persist_directory, "numpy", collection_name)
+        self.dtype = dtype
+        self._lock = threading.RLock()
+        self._load()
+
+    @property
+    def _collection(self):
+        return self
+
+    def _load(self):
+        self.ids, self.documents, self.metadatas = [], [], []
+        self._vectors = None  # The stored rows: the memory map, or a view of _buffer after a write
+        self._scales = None
+        self._buffer = None  # Writable (capacity, dim) matrix whose first count() rows are _vectors
+        self._scale_buffer = None
+        self._unsaved_rows = 0
+        self._vectors_changed = False
+        self._filtered_rows = {}  # Filter (as JSON) -> matching row numbers, reset on every write
         try:
-            summary_store = Chroma(
-                collection_name=summary_collection_name,
-                embedding_function=embeddings,
-                persist_directory=persist_directory
-            )
-            chunk_store = Chroma(
-                collection_name=chunk_collection_name,
-                embedding_function=embeddings,
-                persist_directory=persist_directory
-            )
-            # Verify collections have data
-            summary_count = summary_store._collection.count()
-            chunk_count = chunk_store._collection.count()
-            if summary_count > 0 and chunk_count > 0:
-                logger.info(f"Successfully loaded Chroma stores: {summary_count} summaries, {chunk_count} chunks")
-                return [], summary_store, chunk_store
+            with open(os.path.join(self.directory, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            self._positions = {}
+            return
+        self.ids, self.documents, self.metadatas = meta["ids"], meta["documents"], meta["metadatas"]
+        self.dtype = meta.get("dtype", self.dtype)
+        if self.ids:
+            self._vectors = np.load(os.path.join(self.directory, "vectors.npy"), mmap_mode="r")
+            if self.dtype == "int8":
+                self._scales = np.load(os.path.join(self.directory, "scales.npy"))
+        self._positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+
+    def flush(self):
+        """Write the changes since the last flush to disk; vectors.npy only if vectors changed."""
+        with self._lock:
+            if not self._unsaved_rows:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            if self._vectors_changed and self._vectors is not None:
+                np.save(os.path.join(self.directory, "vectors.tmp.npy"), self._vectors)
+                os.replace(os.path.join(self.directory, "vectors.tmp.npy"), os.path.join(self.directory, "vectors.npy"))
+                if self._scales is not None:
+                    np.save(os.path.join(self.directory, "scales.tmp.npy"), self._scales)
+                    os.replace(os.path.join(self.directory, "scales.tmp.npy"), os.path.join(self.directory, "scales.npy"))
+            tmp_path = os.path.join(self.directory, "meta.json.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({
+                    "dtype": self.dtype,
+                    "ids": self.ids,
+                    "documents": self.documents,
+                    "metadatas": self.metadatas
+                }, f)
+            os.replace(tmp_path, os.path.join(self.directory, "meta.json"))
+            self._unsaved_rows = 0
+            self._vectors_changed = False
+
+    def _changed(self, rows, vectors=True):
+        """Record a write of rows; flushes once numpy_flush_rows rows are unsaved."""
+        self._filtered_rows = {}
+        self._unsaved_rows += rows
+        self._vectors_changed = self._vectors_changed or vectors
+        if self._unsaved_rows >= numpy_flush_rows:
+            self.flush()
+
+    def _reserve(self, rows, dim, dtype):
+        """Make room for rows more vectors in _buffer, growing it geometrically."""
+        size = len(self.ids)
+        if self._buffer is not None and size + rows <= len(self._buffer):
+            return
+        capacity = max(size + rows, 2 * (len(self._buffer) if self._buffer is not None else size), 256)
+        buffer = np.empty((capacity, dim), dtype)
+        scale_buffer = np.empty(capacity, np.float32) if self.dtype == "int8" else None
+        if size:
+            buffer[:size] = self._vectors
+            if scale_buffer is not None:
+                scale_buffer[:size] = self._scales
+        self._buffer, self._scale_buffer = buffer, scale_buffer
+
+    def _encode(self, vectors):
+        """Normalize float vectors and convert them to the storage dtype; returns (matrix, scales)."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return vectors.astype(self.dtype), None
+
+    def _decoded(self, rows=slice(None)):
+        vectors = np.asarray(self._vectors[rows], dtype=np.float32)
+        if self._scales is not None:
+            vectors = vectors * self._scales[rows][:, None]
+        return vectors
+
+    def count(self):
+        return len(self.ids)
+
+    def get(self, ids=None, where=None, include=None, limit=None, offset=None):
+        """Chroma-compatible get: returns {"ids", "documents", "metadatas"[, "embeddings"]}."""
+        include = ["documents", "metadatas"] if include is None else include
+        with self._lock:
+            if ids is not None:
+                positions = [self._positions[doc_id] for doc_id in ids if doc_id in self._positions]
             else:
-                logger.warning("Chroma stores are empty. Rebuilding database...")
+                positions = range(len(self.ids))
+            positions = [i for i in positions if matches_where(self.metadatas[i], where)]
+            positions = positions[offset or 0:(offset or 0) + limit if limit else None]
+            result = {"ids": [self.ids[i] for i in positions]}
+            if "documents" in include:
+                result["documents"] = [self.documents[i] for i in positions]
+            if "metadatas" in include:
+                result["metadatas"] = [self.metadatas[i] for i in positions]
+            if "embeddings" in include:
+                result["embeddings"] = self._decoded(positions).tolist() if positions else []
+            return result
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        encoded, scales = self._encode(embeddings)
+        with self._lock:
+            self._reserve(len(encoded), encoded.shape[1], encoded.dtype)
+            for row, (doc_id, document, metadata) in enumerate(zip(ids, documents, metadatas)):
+                i = self._positions.get(doc_id)
+                if i is None:
+                    i = self._positions[doc_id] = len(self.ids)
+                    self.ids.append(doc_id)
+                    self.documents.append(document)
+                    self.metadatas.append(metadata)
+                else:
+                    self.documents[i], self.metadatas[i] = document, metadata
+                self._buffer[i] = encoded[row]
+                if scales is not None:
+                    self._scale_buffer[i] = scales[row]
+            # Searches already running keep their view of the rows that existed when they started
+            self._vectors = self._buffer[:len(self.ids)]
+            self._scales = self._scale_buffer[:len(self.ids)] if self._scale_buffer is not None else None
+            self._changed(len(encoded))
+
+    def update(self, ids, metadatas=None, documents=None):
+        with self._lock:
+            for row, doc_id in enumerate(ids):
+                i = self._positions.get(doc_id)
+                if i is None:
+                    continue
+                if metadatas is not None:
+                    self.metadatas[i] = metadatas[row]
+                if documents is not None:
+                    self.documents[i] = documents[row]
+            self._changed(len(ids), vectors=False)
+
+    def delete(self, ids):
+        with self._lock:
+            remove = {self._positions[doc_id] for doc_id in ids if doc_id in self._positions}
+            if not remove:
+                return
+            keep = [i for i in range(len(self.ids)) if i not in remove]
+            self._vectors = np.array(self._vectors[keep]) if keep else None
+            self._scales = self._scales[keep] if self._scales is not None and keep else None
+            self._buffer = self._scale_buffer = None  # The next upsert copies the kept rows into a new one
+            self.ids = [self.ids[i] for i in keep]
+            self.documents = [self.documents[i] for i in keep]
+            self.metadatas = [self.metadatas[i] for i in keep]
+            self._positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+            self._changed(len(remove))
+
+    def search_vectors(self, query_vectors, k=4, where=None):
+        """Exact cosine top-k for a batch of query vectors in one matrix product.
+
+        With a where filter only the matching rows are scored; the rows a filter selects are cached
+        until the next write. Returns, per query, a list of (id, document, metadata, similarity)
+        ordered by similarity.
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+        with self._lock:
+            if self._vectors is None:
+                return [[] for _ in queries]
+            vectors, scales, ids = self._vectors, self._scales, self.ids
+            documents, metadatas = self.documents, self.metadatas
+            rows = None
+            if where:
+                key = json.dumps(where, sort_keys=True)
+                rows = self._filtered_rows.get(key)
+                if rows is None:
+                    if len(self._filtered_rows) >= 256:
+                        self._filtered_rows.clear()
+                    rows = self._filtered_rows[key] = np.flatnonzero(
+                        np.array([matches_where(metadata, where) for metadata in metadatas], dtype=bool)
+                    )
+        if rows is not None:
+            vectors = vectors[rows]
+            scales = scales[rows] if scales is not None else None
+        similarities = queries @ np.asarray(vectors, dtype=np.float32).T  # (queries, rows)
+        if scales is not None:
+            similarities *= scales[None, :]
+        k = min(k, similarities.shape[1])
+        if k == 0:
+            return [[] for _ in queries]
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in enumerate(top):
+            ordered = candidates[np.argsort(-similarities[row, candidates])]
+            positions = rows[ordered] if rows is not None else ordered
+            results.append([
+                (ids[i], documents[i], metadatas[i], float(similarities[row, j]))
+                for i, j in zip(positions, ordered)
+            ])
+        return results
+
+    def similarity_search_with_relevance_scores(self, query, k=4, filter=None):
+        """LangChain-compatible search returning [(Document, cosine similarity)]."""
+        from langchain_core.documents import Document
+
+        vector = self.embedding_function.embed_query(query)
+        return [
+            (Document(page_content=document, metadata=metadata), score)
+            for doc_id, document, metadata, score in self.search_vectors([vector], k=k, where=filter)[0]
+        ]
+
+_numpy_stores = {}  # (persist_directory, collection_name) -> NumpyVectorStore, shared like a Chroma DB
+
+def open_store(collection_name):
+    """Open a vector store for a collection with the configured backend (VECTOR_BACKEND)."""
+    if vector_backend == "numpy":
+        key = (persist_directory, collection_name)
+        if key not in _numpy_stores:
+            _numpy_stores[key] = NumpyVectorStore(collection_name, embeddings, persist_directory, dtype=numpy_vector_dtype)
+        return _numpy_stores[key]
+    from langchain_chroma import Chroma
+
+    return Chroma(
+        collection_name=collection_name,
+        embedding_function=embeddings,
+        persist_directory=persist_directory,
+        collection_metadata={"hnsw:space": "cosine"}
+    )
+
+def flush_stores(*stores):
+    """Persist the buffered writes of NumPy stores; Chroma persists every write itself."""
+    for store in stores:
+        if isinstance(store, NumpyVectorStore):
+            store.flush()
+
+@atexit.register
+def flush_numpy_stores():
+    """Persist writes still buffered at shutdown, e.g. those of an ingestion that failed midway."""
+    flush_stores(*_numpy_stores.values())
+
+def store_texts(collection_name, texts, metadatas, ids):
+    """Embed texts in concurrent batches and upsert them into a vector store collection."""
+    store = open_store(collection_name)
+    vectors = embed_texts(texts)
+    for start in range(0, len(texts), embedding_batch_size):
+        end = start + embedding_batch_size
+        store._collection.upsert(
+            ids=ids[start:end],
+            embeddings=vectors[start:end],
+            documents=texts[start:end],
+            metadatas=metadatas[start:end]
+        )
+    return store
+
+def search_by_vectors(store, vectors, k, where=None):
+    """Search a vector store for several query vectors in one call, optionally within a metadata filter.
+
+    Returns, per vector, [(Document, relevance score)] like similarity_search_with_relevance_scores.
+    """
+    from langchain_core.documents import Document
+
+    if isinstance(store, NumpyVectorStore):
+        return [
+            [(Document(page_content=document, metadata=metadata), score) for _, document, metadata, score in hits]
+            for hits in store.search_vectors(vectors, k=k, where=where)
+        ]
+    results = store._collection.query(
+        query_embeddings=[list(vector) for vector in vectors], n_results=k, where=where,
+        include=["documents", "metadatas", "distances"]
+    )
+    # Collections use cosine distance, so relevance is 1 - distance as in LangChain's Chroma
+    return [
+        [(Document(page_content=document, metadata=metadata), 1.0 - distance)
+         for document, metadata, distance in zip(documents, metadatas, distances)]
+        for documents, metadatas, distances in zip(results["documents"], results["metadatas"], results["distances"])
+    ]
+
+class QueryBatcher:
+    """Micro-batches query embeddings and vector searches across concurrent sessions.
+
+    The first request of a batch waits up to window seconds (or until max_batch requests have
+    arrived) and then serves the whole batch: the distinct query texts are embedded with one
+    embed_documents call, and searches of the same store, k and filter run as one batched vector search.
+    Every caller blocks until its own result is ready, so this is meant for worker threads.
+    """
+
+    def __init__(self, embedding_function, window=0.005, max_batch=32):
+        self.embedding_function = embedding_function
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.requests = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._full = threading.Condition(self._lock)
+
+    def embed_query(self, query):
+        """Embedding of one query, batched with concurrent requests."""
+        return self._submit({"query": query, "store": None})["vector"]
+
+    def search(self, store, query, k, where=None):
+        """[(Document, relevance score)] for a query (within a metadata filter), batched with concurrent requests."""
+        return self._submit({"query": query, "store": store, "k": k, "where": where})["results"]
+
+    def _submit(self, item):
+        item["done"] = threading.Event()
+        with self._lock:
+            self._pending.append(item)
+            leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_batch:
+                self._full.notify()
+        if leader:
+            self._lead()
+        while True:
+            item["done"].wait()
+            if not item.pop("lead", False):
+                break
+            # Left over from a batch that was full: serve the next batch
+            item["done"].clear()
+            self._lead()
+        if "error" in item:
+            raise item["error"]
+        return item
+
+    def _lead(self):
+        """Wait for the batch to fill or the window to pass, then serve up to max_batch pending items.
+
+        Items beyond max_batch stay pending, and the first of them is woken to lead the next batch.
+        """
+        with self._lock:
+            if self.window > 0:
+                self._full.wait_for(lambda: len(self._pending) >= self.max_batch, timeout=self.window)
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            if self._pending:
+                self._pending[0]["lead"] = True
+                self._pending[0]["done"].set()
+        self._run(batch)
+
+    def _run(self, batch):
+        try:
+            texts = list(dict.fromkeys(item["query"] for item in batch))
+            vectors = call_with_retry(
+                lambda: self.embedding_function.embed_documents(texts), f"Query embedding batch of {len(texts)}"
+            )
+            vector_by_text = dict(zip(texts, vectors))
+            groups = {}
+            for item in batch:
+                item["vector"] = vector_by_text[item["query"]]
+                if item["store"] is not None:
+                    where = item["where"]
+                    key = (id(item["store"]), item["k"], json.dumps(where, sort_keys=True) if where else None)
+                    groups.setdefault(key, []).append(item)
+            for items in groups.values():
+                store, k, where = items[0]["store"], items[0]["k"], items[0]["where"]
+                with stage("vector_search"):
+                    results = search_by_vectors(store, [item["vector"] for item in items], k, where)
+                for item, hits in zip(items, results):
+                    item["results"] = hits
+            self.batches += 1
+            self.requests += len(batch)
+            metrics.observe("exam_query_batch_size", len(batch))
+            if len(batch) > 1:
+                logger.info(f"Served {len(batch)} queries with one embedding call and {len(groups)} searches")
         except Exception as e:
-            logger.error(f"Failed to load Chroma stores: {e}. Rebuilding database...")
+            for item in batch:
+                item["error"] = e
+        finally:
+            for item in batch:
+                item["done"].set()
 
-    # If no DB exists or loading failed, process the PDF
-    logger.info("Processing PDF to create new Chroma vector stores.")
-    text = extract_text_from_pdf(pdf_path)
-    if not text:
-        logger.warning("No text extracted. Creating empty vector stores.")
-        return [], Chroma(persist_directory=persist_directory, embedding_function=embeddings, collection_name=summary_collection_name), Chroma(persist_directory=persist_directory, embedding_function=embeddings, collection_name=chunk_collection_name)
-
-    # Split text into chunks
-    text_splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    chunks = text_splitter.split_text(text)
-    logger.info(f"Created {len(chunks)} chunks with chunk_size={chunk_size}, chunk_overlap={chunk_overlap}")
-
-    # Generate summaries and prepare metadata
-    summaries = []
-    chunk_texts = []
-    summary_metadatas = []
-    chunk_metadatas = []
-    for i, chunk in enumerate(chunks):
-        chunk_id = str(uuid.uuid4())
-        summary = generate_summary(chunk, i)
-        summaries.append(summary)
-        chunk_texts.append(chunk)
-        summary_metadatas.append({"chunk_id": chunk_id, "index": i})
-        chunk_metadatas.append({"chunk_id": chunk_id, "index": i})
-
-    # Create Chroma vector stores
+query_batcher = QueryBatcher(
+    embeddings, window=query_batch_window_ms / 1000, max_batch=query_batch_max_size
+)
+
+class BM25Index:
+    """In-process BM25 index over chunk text plus summary, keyed by chunk_id.
+
+    Complements dense search on exact terms such as fee amounts, form names and clause numbers.
+    """
+
+    format_version = 1
+    _token_pattern = re.compile(r"[a-z0-9]+(?:[.\-/][a-z0-9]+)*")
+
+    def __init__(self, doc_ids, doc_lengths, postings, k1=1.5, b=0.75):
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.postings = postings  # term -> [[doc index, term frequency], ...]
+        self.k1 = k1
+        self.b = b
+        self.avg_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0
+        n = len(doc_ids)
+        self.idf = {
+            term: math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in postings.items()
+        }
+
+    @classmethod
+    def tokenize(cls, text):
+        return cls._token_pattern.findall(text.lower())
+
+    @classmethod
+    def build(cls, documents):
+        """Build from a {chunk_id: text} mapping."""
+        doc_ids, doc_lengths, postings = [], [], {}
+        for doc_index, (doc_id, text) in enumerate(documents.items()):
+            tokens = cls.tokenize(text)
+            doc_ids.append(doc_id)
+            doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append([doc_index, count])
+        return cls(doc_ids, doc_lengths, postings)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format_version") != cls.format_version:
+            raise ValueError(f"Unsupported BM25 index format: {data.get('format_version')}")
+        return cls(data["doc_ids"], data["doc_lengths"], data["postings"])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump({
+                "format_version": self.format_version,
+                "doc_ids": self.doc_ids,
+                "doc_lengths": self.doc_lengths,
+                "postings": self.postings
+            }, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def search(self, query, k=10, allowed=None):
+        """Return [(chunk_id, score)] for the top k documents by BM25 score, only among allowed chunk IDs if given."""
+        scores = {}
+        for term in set(self.tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_index, tf in self.postings[term]:
+                if allowed is not None and self.doc_ids[doc_index] not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_index] / self.avg_length)
+                scores[doc_index] = scores.get(doc_index, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.doc_ids[doc_index], score) for doc_index, score in top]
+
+def load_chunk_map(summary_store, chunk_store):
+    """Load every chunk with its summary into memory as {chunk_id: {"text", "summary", "metadata"}}."""
+    chunks = chunk_store._collection.get(include=["documents", "metadatas"])
+    summaries = summary_store._collection.get(include=["documents", "metadatas"])
+    summary_by_id = {
+        meta.get("chunk_id"): doc for doc, meta in zip(summaries["documents"], summaries["metadatas"])
+    }
+    return {
+        meta.get("chunk_id"): {"text": doc, "summary": summary_by_id.get(meta.get("chunk_id"), ""), "metadata": meta}
+        for doc, meta in zip(chunks["documents"], chunks["metadatas"])
+    }
+
+def build_lexical_index(chunk_map, path=None):
+    """Build the BM25 index from the stored chunks and summaries and persist it with the DB."""
+    path = path or lexical_index_path
+    index = BM25Index.build({
+        chunk_id: f"{chunk['text']}\n{chunk['summary']}" for chunk_id, chunk in chunk_map.items()
+    })
     try:
-        logger.info(f"Storing {len(chunks)} summaries in {summary_collection_name}")
-        summary_store = Chroma.from_texts(
-            texts=summaries,
-            embedding=embeddings,
-            collection_name=summary_collection_name,
-            persist_directory=persist_directory,
-            metadatas=summary_metadatas,
-            collection_metadata={"hnsw:space": "cosine"}
-        )
-        logger.info(f"Storing {len(chunks)} chunks in {chunk_collection_name}")
-        chunk_store = Chroma.from_texts(
-            texts=chunk_texts,
-            embedding=embeddings,
-            collection_name=chunk_collection_name,
-            persist_directory=persist_directory,
-            metadatas=chunk_metadatas,
-            collection_metadata={"hnsw:space": "cosine"}
-        )
-        logger.info(f"Saved {len(chunks)} summaries and chunks to local Chroma database at {persist_directory}")
-        return chunks, summary_store, chunk_store
+        index.save(path)
+    except OSError as e:
+        logger.warning(f"Could not persist BM25 index: {e}")
+    logger.info(f"Built BM25 index over {len(chunk_map)} chunks")
+    return index
+
+def load_lexical_index(chunk_map, path=None):
+    """Load the persisted BM25 index, rebuilding it if missing or out of sync with the chunks."""
+    path = path or lexical_index_path
+    try:
+        index = BM25Index.load(path)
+        if set(index.doc_ids) == chunk_map.keys():
+            return index
+        logger.warning("BM25 index is out of sync with the chunk store. Rebuilding...")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not load BM25 index: {e}. Rebuilding...")
+    return build_lexical_index(chunk_map, path)
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuse ranked lists of IDs into one ranking of (id, score) by reciprocal rank."""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+def file_sha256(path):
+    """Compute the SHA-256 hex digest of a file, reading it in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def chunk_content_id(chunk):
+    """Deterministic chunk ID derived from the chunk text."""
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+def load_manifest(path=None):
+    """Load an ingestion manifest (by default the main PDF's), or None if missing or unreadable."""
+    path = path or manifest_path
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
     except Exception as e:
-        logger.error(f"Error creating vector stores: {e}")
-        return [], Chroma(persist_directory=persist_directory, embedding_function=embeddings, collection_name=summary_collection_name), Chroma(persist_directory=persist_directory, embedding_function=embeddings, collection_name=chunk_collection_name)
+        logger.warning(f"Could not read ingestion manifest {path}: {e}")
+        return None
+
+def save_manifest(manifest, path=None):
+    """Atomically write an ingestion manifest (by default the main PDF's)."""
+    path = path or manifest_path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+class DocumentShard:
+    """One ingested PDF: its summary and chunk collections, manifest, chunk map and BM25 index."""
+
+    def __init__(self, doc_id, title, pdf_path, summary_collection, chunk_collection, manifest_path, lexical_index_path):
+        self.doc_id = doc_id
+        self.title = title
+        self.pdf_path = pdf_path
+        self.summary_collection = summary_collection
+        self.chunk_collection = chunk_collection
+        self.manifest_path = manifest_path
+        self.lexical_index_path = lexical_index_path
+        self.summary_store = None
+        self.chunk_store = None
+        self.chunk_map = {}  # chunk_id -> chunk text, summary and metadata, loaded by process_document
+        self.lexical_index = None  # BM25 index, loaded by process_document
+        self.sections = {}  # Section path -> chunk IDs, for section-filtered retrieval
+        self.lock = threading.Lock()  # One process_document run per document at a time
+
+    @classmethod
+    def for_corpus_file(cls, path):
+        """Shard for a PDF in the corpus directory, with collections and files named after it."""
+        name = os.path.basename(path)
+        slug = re.sub(r"[^a-z0-9]+", "_", Path(name).stem.lower()).strip("_")[:40] or "document"
+        doc_id = f"{slug}_{hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]}"
+        directory = os.path.join(persist_directory, "corpus", doc_id)
+        return cls(
+            doc_id, Path(name).stem.replace("_", " ").replace("-", " ").strip(), path,
+            f"{doc_id}_summaries", f"{doc_id}_chunks",
+            os.path.join(directory, "ingestion_manifest.json"), os.path.join(directory, "bm25_index.json.gz")
+        )
+
+# The examination manual keeps the original collection names, so existing databases stay valid
+primary_shard = DocumentShard(
+    "examination_manual", "Examination Manual", pdf_path,
+    summary_collection_name, chunk_collection_name, manifest_path, lexical_index_path
+)
+
+def load_stores(shard=None):
+    """Open the persisted summary and chunk vector stores of a document (by default the main PDF)."""
+    shard = shard or primary_shard
+    return open_store(shard.summary_collection), open_store(shard.chunk_collection)
+
+def process_document(pdf_path, chunk_size=800, chunk_overlap=200, shard=None):
+    """Process PDF and incrementally sync the summary and chunk vector stores with it.
+
+    Ingestion streams pages -> chunks -> summaries -> embeddings and commits chunks in batches
+    of INGEST_BATCH_SIZE, so memory stays flat and committed batches are searchable while the
+    rest of the PDF is processed. Chunks are keyed by a hash of their content, so re-ingesting
+    a new edition, or resuming after a crash, only summarizes and embeds chunks that are not
+    stored yet; chunks no longer in the PDF are deleted once the whole PDF has been read.
+    Chunks follow the PDF's table of contents (a chunk never spans two sections) and record their
+    document, page range and section path. The stores, chunk map, BM25 index and section index used
+    by hierarchical_retrieval are published on the shard (by default the examination manual's).
+
+    Returns (number of chunks, summary_store, chunk_store).
+    """
+    shard = shard or primary_shard
+    with shard.lock:
+        pdf_hash = file_sha256(pdf_path) if os.path.exists(pdf_path) else None
+        manifest = load_manifest(shard.manifest_path)
+        same_source = manifest is not None and manifest.get("pdf_hash") == pdf_hash \
+            and manifest.get("chunk_size") == chunk_size and manifest.get("chunk_overlap") == chunk_overlap \
+            and manifest.get("chunker") == chunker_version
+
+        # Reuse the existing DB if it was fully built from this exact PDF with the same settings
+        if os.path.exists(persist_directory) and os.listdir(persist_directory):
+            logger.info(f"Found existing vector database at {persist_directory}. Attempting to load...")
+            try:
+                summary_store, chunk_store = load_stores(shard)
+                # Verify collections have data
+                summary_count = summary_store._collection.count()
+                chunk_count = chunk_store._collection.count()
+                up_to_date = same_source and manifest.get("status", "complete") == "complete"
+                if summary_count > 0 and chunk_count > 0 and (up_to_date or pdf_hash is None):
+                    logger.info(f"Successfully loaded vector stores: {summary_count} summaries, {chunk_count} chunks")
+                    shard.chunk_map = load_chunk_map(summary_store, chunk_store)
+                    shard.lexical_index = load_lexical_index(shard.chunk_map, shard.lexical_index_path)
+                    shard.sections = build_section_index(shard.chunk_map)
+                    shard.summary_store, shard.chunk_store = summary_store, chunk_store
+                    return chunk_count, summary_store, chunk_store
+                elif same_source and manifest.get("status") == "in_progress":
+                    logger.info(f"Resuming interrupted ingestion after {manifest.get('batches', 0)} committed batches")
+                elif same_source and manifest.get("status") == "incomplete":
+                    logger.info(f"Retrying {manifest.get('failed_summaries', 0)} chunk summaries that failed last time")
+                elif summary_count > 0 and chunk_count > 0:
+                    logger.info("PDF or chunking settings changed since last ingestion. Re-indexing changed chunks...")
+                else:
+                    logger.warning("Vector stores are empty. Rebuilding database...")
+            except Exception as e:
+                logger.error(f"Failed to load vector stores: {e}. Rebuilding database...")
+
+        # If no DB exists, loading failed, the PDF changed or the last run was interrupted, process the PDF
+        if pdf_hash is None:
+            logger.error(f"PDF file not found: {pdf_path}. Creating empty vector stores.")
+            return 0, *load_stores(shard)
+        logger.info(f"Processing {pdf_path} to sync vector stores.")
+        try:
+            summary_store, chunk_store = load_stores(shard)
+            shard.summary_store, shard.chunk_store = summary_store, chunk_store
+            chunk_ids = set(chunk_store._collection.get(include=[])["ids"])
+            stored_summaries = summary_store._collection.get(include=["documents"])
+            summary_ids = set(stored_summaries["ids"])
+            placeholder_ids = {
+                chunk_id for chunk_id, summary in zip(stored_summaries["ids"], stored_summaries["documents"])
+                if summary == failed_summary_placeholder
+            }
+            # Chunks that were only partially stored, or whose summary failed, are treated as new
+            stored_ids = (chunk_ids & summary_ids) - placeholder_ids
+            chunk_map = shard.chunk_map = load_chunk_map(summary_store, chunk_store) if stored_ids else {}
+            progress = {
+                "pdf_path": str(pdf_path),
+                "pdf_hash": pdf_hash,
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap,
+                "chunker": chunker_version,
+                "status": "in_progress",
+                "batches": 0,
+                "stored_chunks": 0,
+                "updated_at": time.time()
+            }
+            save_manifest(progress, shard.manifest_path)
+
+            # Key chunks by content hash; identical chunks collapse to their first occurrence
+            chunk_index = {}
+
+            def unique_chunks():
+                with fitz.open(pdf_path) as pdf:
+                    toc = pdf.get_toc()
+                pages = iter_pdf_pages(pdf_path)
+                chunks = iter_section_chunks(pages, toc, chunk_size, chunk_overlap)
+                for i, (chunk, first_page, last_page, section) in enumerate(chunks):
+                    chunk_id = chunk_content_id(chunk)
+                    if chunk_id not in chunk_index:
+                        chunk_index[chunk_id] = i
+                        metadata = {
+                            "chunk_id": chunk_id, "index": i, "document": shard.doc_id,
+                            "page_start": first_page, "page_end": last_page,
+                            "section": section_separator.join(section)
+                        }
+                        yield chunk_id, metadata, chunk
+
+            def summarize(item):
+                chunk_id, metadata, chunk = item
+                if chunk_id in stored_ids:
+                    return chunk_id, metadata, chunk, None, True
+                return chunk_id, metadata, chunk, generate_summary(chunk, metadata["index"]), False
+
+            new_count = 0
+            failed_count = 0
+            summarized = ordered_map(summarize, unique_chunks(), summary_max_workers)
+            for batch in batched(summarized, ingest_batch_size):
+                kept = [item[:4] for item in batch if item[4]]
+                new = [item[:4] for item in batch if not item[4] and item[3] is not None]
+                # Chunks whose summary failed are stored without one: BM25 finds them, and the next
+                # ingestion summarizes them again since they aren't in both stores
+                failed = [item[:4] for item in batch if not item[4] and item[3] is None]
+
+                # Unchanged chunks keep their embeddings; only refresh their position in the document
+                if kept:
+                    kept_ids = [chunk_id for chunk_id, _, _, _ in kept]
+                    kept_metadatas = [metadata for _, metadata, _, _ in kept]
+                    summary_store._collection.update(ids=kept_ids, metadatas=kept_metadatas)
+                    chunk_store._collection.update(ids=kept_ids, metadatas=kept_metadatas)
+                    for chunk_id, metadata in zip(kept_ids, kept_metadatas):
+                        if chunk_id in chunk_map:
+                            chunk_map[chunk_id]["metadata"] = metadata
+
+                # Store chunks before their summaries, so a summary found by search always resolves
+                if new:
+                    new_ids = [chunk_id for chunk_id, _, _, _ in new]
+                    metadatas = [metadata for _, metadata, _, _ in new]
+                    store_texts(shard.chunk_collection, [chunk for _, _, chunk, _ in new], metadatas, new_ids)
+                    store_texts(shard.summary_collection, [summary for _, _, _, summary in new], metadatas, new_ids)
+                    for (chunk_id, _, chunk, summary), metadata in zip(new, metadatas):
+                        chunk_map[chunk_id] = {"text": chunk, "summary": summary, "metadata": metadata}
+                    new_count += len(new)
+                if failed:
+                    failed_ids = [chunk_id for chunk_id, _, _, _ in failed]
+                    metadatas = [metadata for _, metadata, _, _ in failed]
+                    store_texts(shard.chunk_collection, [chunk for _, _, chunk, _ in failed], metadatas, failed_ids)
+                    stale_placeholders = [chunk_id for chunk_id in failed_ids if chunk_id in placeholder_ids]
+                    if stale_placeholders:
+                        summary_store._collection.delete(ids=stale_placeholders)
+                    for (chunk_id, _, chunk, _), metadata in zip(failed, metadatas):
+                        chunk_map[chunk_id] = {"text": chunk, "summary": "", "metadata": metadata}
+                    failed_count += len(failed)
+
+                progress["batches"] += 1
+                progress["stored_chunks"] = new_count
+                progress["updated_at"] = time.time()
+                save_manifest(progress, shard.manifest_path)
+                ingestion_progress(shard, progress)
+                logger.info(f"{shard.doc_id}: committed batch {progress['batches']}: {len(new)} new, {len(kept)} unchanged chunks")
+
+            if not chunk_index:
+                logger.warning("No text extracted. Ensure pytesseract and Pillow are installed for OCR support.")
+                flush_stores(summary_store, chunk_store)
+                return 0, summary_store, chunk_store
 
-def hierarchical_retrieval(query, summary_store, chunk_store, k=2):
-    """Retrieve documents using hierarchical RAG: search summaries, then fetch detailed chunks."""
+            # Drop chunks that are no longer in the PDF (and summaries orphaned by an interrupted run)
+            removed_ids = list((chunk_ids | summary_ids) - chunk_index.keys())
+            if removed_ids:
+                logger.info(f"Deleting {len(removed_ids)} chunks no longer present in the PDF")
+                summary_store._collection.delete(ids=removed_ids)
+                chunk_store._collection.delete(ids=removed_ids)
+                for chunk_id in removed_ids:
+                    chunk_map.pop(chunk_id, None)
+            logger.info(
+                f"Chunk changes: {new_count} new, {len(chunk_index) - new_count - failed_count} unchanged, "
+                f"{len(removed_ids)} removed (chunk_size={chunk_size}, chunk_overlap={chunk_overlap})"
+            )
+
+            # Answers cached against the previous index may no longer be accurate
+            answer_cache.clear()
+            shard.lexical_index = build_lexical_index(chunk_map, shard.lexical_index_path)
+            shard.sections = build_section_index(chunk_map)
+            flush_stores(summary_store, chunk_store)  # Before the manifest says the stores are complete
+            # With failed summaries the manifest stays incomplete, so the next start retries them
+            progress.update({
+                "status": "incomplete" if failed_count else "complete", "failed_summaries": failed_count,
+                "chunk_ids": list(chunk_index), "updated_at": time.time()
+            })
+            save_manifest(progress, shard.manifest_path)
+            if failed_count:
+                logger.warning(f"{failed_count} chunk summaries failed; they are retried on the next ingestion")
+            logger.info(f"Synced {len(chunk_index)} summaries and chunks to local vector database at {persist_directory}")
+            return len(chunk_index), summary_store, chunk_store
+        except Exception as e:
+            logger.error(f"Error updating vector stores for {pdf_path}: {e}")
+            return 0, *load_stores(shard)
+
+def retrieval_candidates(query, summary_store, k, lexical_index=None, sections=None):
+    """Candidate chunks of one document for a query: ({chunk_id: vector score}, {chunk_id: summary}, {chunk_id: BM25 score}).
+
+    Vector scores are the cosine relevance of each chunk's summary, best first. sections
+    ({section path: chunk IDs}, see find_sections) restricts both searches to those sections.
+    """
+    candidates = k * 4 if lexical_index is not None else k * 2  # Broader search for summaries
+    where, allowed = None, None
+    if sections is not None:
+        if not sections:
+            logger.warning("No chunks in the requested section.")
+            return {}, {}, {}
+        where = {"section": {"$in": list(sections)}}
+        allowed = {chunk_id for chunk_ids in sections.values() for chunk_id in chunk_ids}
+    # Step 1: Search summaries, keeping their similarity scores
+    with stage("summary_search"):
+        summary_results = query_batcher.search(summary_store, query, candidates, where)
+    logger.info(f"Retrieved {len(summary_results)} summaries for query")
+    vector_scores = {}
+    summaries = {}
+    for doc, score in summary_results:
+        chunk_id = doc.metadata.get("chunk_id")
+        if chunk_id and chunk_id not in vector_scores:
+            vector_scores[chunk_id] = score
+            summaries[chunk_id] = doc.page_content
+
+    # Step 2: Search the lexical index
+    lexical_scores = {}
+    if lexical_index is not None:
+        with stage("lexical_search"):
+            lexical_scores = dict(lexical_index.search(query, k=candidates, allowed=allowed))
+    return vector_scores, summaries, lexical_scores
+
+def rank_candidates(vector_scores, lexical_scores, k, fuse):
+    """Top k candidate keys as [(key, score 0-1)]: by reciprocal rank fusion of both rankings if fuse, else by vector score."""
+    by_vector = sorted(vector_scores, key=vector_scores.get, reverse=True)
+    if not fuse:
+        return [(key, vector_scores[key]) for key in by_vector[:k]]
+    by_lexical = sorted(lexical_scores, key=lexical_scores.get, reverse=True)
+    fused = reciprocal_rank_fusion([by_vector, by_lexical], k=rrf_k)
+    max_fused = 2.0 / (rrf_k + 1)  # Ranked first by both retrievers
+    logger.info(f"Fused {len(vector_scores)} vector and {len(lexical_scores)} lexical candidates")
+    return [(key, score / max_fused) for key, score in fused[:k]]
+
+def lookup_chunks(chunk_ids, chunk_store, chunk_map=None):
+    """{chunk_id: {"text", "metadata"[, "summary"]}} from chunk_map when given, otherwise with one ID lookup in chunk_store."""
+    if chunk_map is not None:
+        return {chunk_id: chunk_map[chunk_id] for chunk_id in chunk_ids if chunk_id in chunk_map}
+    chunk_docs = chunk_store.get(ids=list(chunk_ids))
+    return {
+        meta.get("chunk_id"): {"text": doc, "metadata": meta}
+        for doc, meta in zip(chunk_docs.get("documents", []), chunk_docs.get("metadatas", []))
+    }
+
+def retrieved_doc(chunk, summary, score, vector_score, lexical_score):
+    return {
+        "text": chunk["text"],
+        "metadata": chunk["metadata"],
+        "summary": summary if summary is not None else chunk.get("summary", ""),
+        "score": score,
+        "vector_score": vector_score,
+        "lexical_score": lexical_score
+    }
+
+@staged("retrieval")
+def hierarchical_retrieval(query, summary_store, chunk_store, k=2, lexical_index=None, chunk_map=None, sections=None):
+    """Retrieve documents using hierarchical RAG: search summaries, then resolve their detailed chunks.
+
+    With a BM25 lexical_index, the summary ranking and the BM25 ranking are fused by reciprocal rank.
+    sections ({section path: chunk IDs}, see find_sections) restricts both searches to those sections.
+    Chunks are resolved from chunk_map when given, otherwise with one ID lookup in chunk_store.
+    Each returned doc carries real scores: "score" (final ranking, 0-1), "vector_score" (cosine
+    relevance of its summary, or None) and "lexical_score" (BM25, or None).
+    """
     try:
         logger.info(f"Processing query: {query[:50]}...")
-        # Step 1: Search summaries
-        summary_retriever = summary_store.as_retriever(search_kwargs={"k": k * 2})  # Broader search for summaries
-        summary_docs = summary_retriever.invoke(query)
-        logger.info(f"Retrieved {len(summary_docs)} summaries for query")
-
-        # Step 2: Get corresponding chunks
-        chunk_ids = [doc.metadata.get("chunk_id") for doc in summary_docs if doc.metadata.get("chunk_id")]
-        if not chunk_ids:
+        vector_scores, summaries, lexical_scores = retrieval_candidates(query, summary_store, k, lexical_index, sections)
+        ranked = rank_candidates(vector_scores, lexical_scores, k, fuse=lexical_index is not None)
+        if not ranked:
             logger.warning("No relevant summaries found.")
             return []
 
-        # Query chunk store using chunk IDs
-        chunk_docs = chunk_store.get(where={"chunk_id": {"$in": chunk_ids}})
+        # Step 3: Get corresponding chunks in ranked order
+        with stage("chunk_lookup"):
+            chunks = lookup_chunks([chunk_id for chunk_id, _ in ranked], chunk_store, chunk_map)
         retrieved_docs = [
-            {"text": doc, "metadata": meta}
-            for doc, meta in zip(chunk_docs.get("documents", []), chunk_docs.get("metadatas", []))
+            retrieved_doc(chunks[chunk_id], summaries.get(chunk_id), score,
+                          vector_scores.get(chunk_id), lexical_scores.get(chunk_id))
+            for chunk_id, score in ranked if chunk_id in chunks
         ]
         logger.info(f"Retrieved {len(retrieved_docs)} detailed chunks")
-        return retrieved_docs[:k]  # Return up to k documents
+        return retrieved_docs
     except Exception as e:
         logger.error(f"Error in hierarchical retrieval: {e}")
         return []
 
-def generate_response(query, docs, history):
-    """Generate response using retrieved documents and conversation history."""
-    # Prepare context with better formatting and structure
-    if docs:
-        context_parts = []
-        for i, doc in enumerate(docs):
-            # Add source number and text with clear separation
-            context_parts.append(f"SOURCE {i+1}:\n{doc['text']}")
-        context = "\n\n".join(context_parts)
-    else:
+@staged("routing")
+def route_query(query, shards, top_n):
+    """Pick the top_n documents whose summaries best match the query (all of them if top_n is 0)."""
+    if top_n <= 0 or len(shards) <= top_n or document_store is None:
+        return shards
+    try:
+        results = query_batcher.search(document_store, query, top_n)
+    except Exception as e:
+        logger.warning(f"Document routing failed: {e}. Searching all documents.")
+        return shards
+    by_id = {shard.doc_id: shard for shard in shards}
+    routed = [by_id[doc.metadata["document"]] for doc, _ in results if doc.metadata.get("document") in by_id]
+    logger.info(f"Routed query to {[shard.doc_id for shard in routed]}")
+    return routed or shards
+
+def retrieve(query, k=2, section=None):
+    """Retrieve the top k chunks for a query across the served documents.
+
+    A single document is searched directly. In corpus mode the query is routed to the most likely
+    documents and their shards are searched in parallel, so latency stays close to a single search
+    as documents are added. The shards' candidates are then ranked together (one fusion over the
+    combined vector and BM25 rankings), since scores normalized per shard aren't comparable. With a
+    section (a TOC heading or path), only the documents that have it are searched, and only within
+    that section.
+    """
+    shards = [shard for shard in document_shards.values() if shard.summary_store is not None]
+    sections = {shard.doc_id: find_sections(shard.sections, section) for shard in shards} if section else {}
+
+    def search(shard):
+        return hierarchical_retrieval(
+            query, shard.summary_store, shard.chunk_store, k=k,
+            lexical_index=shard.lexical_index if hybrid_retrieval else None,
+            chunk_map=shard.chunk_map or None,
+            sections=sections.get(shard.doc_id) if section else None
+        )
+
+    if len(shards) <= 1:
+        return search(shards[0]) if shards else []
+    if section:
+        shards = [shard for shard in shards if sections[shard.doc_id]]
+        if len(shards) <= 1:
+            return search(shards[0]) if shards else []
+    query_batcher.embed_query(query)  # Embed once; the parallel searches below then hit the embedding cache
+    if not section:
+        shards = route_query(query, shards, route_top_documents)
+    return merged_retrieval(query, shards, k, sections if section else None)
+
+@staged("retrieval")
+def merged_retrieval(query, shards, k, sections=None):
+    """Top k chunks over several shards, ranked as one candidate pool keyed by (doc_id, chunk_id).
+
+    Cosine relevance is comparable across shards (one embedding model); BM25 scores are merged on
+    their raw values.
+    """
+    try:
+        def candidates(shard):
+            return retrieval_candidates(
+                query, shard.summary_store, k, shard.lexical_index if hybrid_retrieval else None,
+                sections.get(shard.doc_id) if sections is not None else None
+            )
+
+        futures = {shard.doc_id: submit_in_context(retrieval_executor, candidates, shard) for shard in shards}
+        vector_scores, summaries, lexical_scores = {}, {}, {}
+        for doc_id, future in futures.items():
+            shard_vector, shard_summaries, shard_lexical = future.result()
+            vector_scores.update(((doc_id, chunk_id), score) for chunk_id, score in shard_vector.items())
+            summaries.update(((doc_id, chunk_id), summary) for chunk_id, summary in shard_summaries.items())
+            lexical_scores.update(((doc_id, chunk_id), score) for chunk_id, score in shard_lexical.items())
+        ranked = rank_candidates(vector_scores, lexical_scores, k, fuse=hybrid_retrieval)
+        with stage("chunk_lookup"):
+            chunks = {}
+            by_shard = {shard.doc_id: shard for shard in shards}
+            for doc_id in {doc_id for (doc_id, _), _ in ranked}:
+                shard = by_shard[doc_id]
+                found = lookup_chunks([chunk_id for (d, chunk_id), _ in ranked if d == doc_id],
+                                      shard.chunk_store, shard.chunk_map or None)
+                chunks.update(((doc_id, chunk_id), chunk) for chunk_id, chunk in found.items())
+        return [
+            retrieved_doc(chunks[key], summaries.get(key), score, vector_scores.get(key), lexical_scores.get(key))
+            for key, score in ranked if key in chunks
+        ]
+    except Exception as e:
+        logger.error(f"Error in corpus retrieval: {e}")
+        return []
+
+min_overlap_chars = 40  # Shorter repeats between sources are left alone
+min_source_tokens = 50  # A source that would be cut shorter than this is dropped instead
+
+def overlap_length(left, right):
+    """Length of the longest suffix of left that is also a prefix of right, or 0 below min_overlap_chars."""
+    probe = right[:min_overlap_chars]
+    if len(probe) < min_overlap_chars:
+        return 0
+    # The earliest match is the longest overlap; it can't start before len(left) - len(right)
+    start = left.find(probe, max(0, len(left) - len(right)))
+    while start != -1:
+        if right.startswith(left[start:]):
+            return len(left) - start
+        start = left.find(probe, start + 1)
+    return 0
+
+def remove_overlap(text, included):
+    """text without the parts it shares with the already included source texts.
+
+    Neighbouring chunks repeat chunk_overlap characters, so a chunk's head can repeat the end of
+    the previous chunk and its tail the start of the next one.
+    """
+    for other in included:
+        if text in other:
+            return ""
+        text = text[overlap_length(other, text):]
+        tail = overlap_length(text, other)
+        if tail:
+            text = text[:-tail]
+    return text.strip()
+
+def source_label(number, metadata):
+    """SOURCE heading for a chunk, with its document title (in corpus mode), section and pages to cite."""
+    shard = document_shards.get(metadata.get('document')) if len(document_shards) > 1 else None
+    details = [shard.title] if shard else []
+    if metadata.get('section'):
+        details.append(metadata['section'])
+    if metadata.get('page_start') is not None:
+        first, last = metadata['page_start'] + 1, metadata.get('page_end', metadata['page_start']) + 1
+        details.append(f"page {first}" if first == last else f"pages {first}-{last}")
+    return f"SOURCE {number} ({'; '.join(details)})" if details else f"SOURCE {number}"
+
+def source_citation(metadata):
+    """What the client needs to show a source and jump to its page (image_url is None outside the manual)."""
+    page = metadata.get('page_start')
+    in_manual = metadata.get('document', primary_shard.doc_id) == primary_shard.doc_id
+    return {
+        'document': metadata.get('document'),
+        'section': metadata.get('section', ''),
+        'page_start': page,
+        'page_end': metadata.get('page_end', page),
+        'image_url': page_image_url(page, 2.0) if page is not None and in_manual and os.path.exists(pdf_path) else None
+    }
+
+def assemble_context(docs, budget):
+    """The CONTEXT section for docs within budget tokens, and its token count.
+
+    Sources keep their rank order; text repeated from a higher-ranked source is removed, and the
+    first source that doesn't fit is shortened to the remaining budget (or dropped if too little is left).
+    """
+    if not docs:
         context = "No relevant information found in the examination manual."
+        return context, count_tokens(context)
+    parts, included, used = [], [], 0
+    for number, doc in enumerate(docs, 1):
+        text = remove_overlap(doc['text'], included)
+        if not text:
+            continue
+        label = source_label(number, doc['metadata'])  # Numbered by rank, like the sources sent to the client
+        label_tokens = count_tokens(f"{label}:\n") + 1  # And the blank line between sources
+        text_tokens = count_tokens(text)
+        if used + label_tokens + text_tokens > budget:
+            remaining = budget - used - label_tokens
+            if remaining >= min_source_tokens:
+                parts.append(f"{label}:\n{truncate_tokens(text, remaining)}")
+                used += label_tokens + remaining
+            break
+        parts.append(f"{label}:\n{text}")
+        included.append(doc['text'])
+        used += label_tokens + text_tokens
+    return "\n\n".join(parts), used
 
-    # Build conversation history string with clear formatting
-    history_text = ""
-    if history:
-        history_text = "Previous conversation:\n"
-        for hist_query, hist_response in history[-max_history:]:
-            history_text += f"User: {hist_query}\nAssistant: {hist_response}\n\n"
-
-    # Enhanced prompt with better instructions for maintaining context
-    prompt = PromptTemplate(
-        input_variables=["history", "context", "question"],
-        template=(
-            "You are a chatbot assisting with Bennett University's Examination Manual. "
-            "Your goal is to provide accurate, helpful information while maintaining proper context throughout the conversation.\n\n"
-            "INSTRUCTIONS:\n"
-            "1. Use the conversation history to understand the context of the current question\n"
-            "2. Reference the provided context from the manual to answer accurately\n"
-            "3. Maintain continuity with previous exchanges\n"
-            "4. If the question relates to previous questions, acknowledge that relationship\n"
-            "5. If information is missing from the context, clearly state that you don't have that specific information\n"
-            "6. Always cite the relevant section from the manual when possible\n"
-            "7. Be concise but complete in your response\n\n"
-            "{history}\n\n"
-            "CONTEXT FROM EXAMINATION MANUAL:\n{context}\n\n"
-            "CURRENT QUESTION: {question}\n\n"
-            "RESPONSE:"
-        )
-    )
+def compact_turn(query, response):
+    """One line standing in for an older exchange: the question and the first sentence of the answer."""
+    first_sentence = re.split(r"(?<=[.!?])\s", response.strip(), maxsplit=1)[0]
+    return f"- Asked: {truncate_tokens(query, 30)} Answered: {truncate_tokens(first_sentence, 40)}\n"
+
+def assemble_history(history, budget):
+    """The conversation history section within budget tokens, and its token count.
+
+    The last max_history exchanges are kept verbatim (long answers shortened), and older ones as a
+    rolling summary of one line each. Newer exchanges win when the budget runs out.
+    """
+    if not history or budget <= 0:
+        return "", 0
+    recent, older = history[-max_history:], history[:-max_history]
+    header, summary_header = "Previous conversation:\n", "Earlier in this conversation:\n"
+    used = count_tokens(header)
+    recent_parts, summary_lines = [], []
+    for hist_query, hist_response in reversed(recent):
+        part = f"User: {hist_query}\nAssistant: {truncate_tokens(hist_response, history_answer_tokens)}\n\n"
+        tokens = count_tokens(part)
+        if used + tokens > budget:
+            break
+        recent_parts.insert(0, part)
+        used += tokens
+    if not recent_parts:
+        return "", 0
+    if older and len(recent_parts) == len(recent):
+        used += count_tokens(summary_header) + 1
+        for hist_query, hist_response in reversed(older):
+            line = compact_turn(hist_query, hist_response)
+            tokens = count_tokens(line)
+            if used + tokens > budget:
+                break
+            summary_lines.insert(0, line)
+            used += tokens
+    if not summary_lines:
+        return header + "".join(recent_parts), count_tokens(header) + sum(count_tokens(part) for part in recent_parts)
+    return summary_header + "".join(summary_lines) + "\n" + header + "".join(recent_parts), used
+
+@staged("generation")
+def generate_response(query, docs, history, on_token=None):
+    """Generate response using retrieved documents and conversation history.
+
+    If on_token is given, the answer is streamed from the LLM and on_token is called with each piece of text.
+    """
+    prompt_start = time.perf_counter()
+    prompt = compiled_prompt(answer_template)
+    # Whatever the instructions and question leave of the budget goes to history (capped) and then sources
+    available = prompt_token_budget - static_prompt_tokens(answer_template) - count_tokens(query)
+    history_text, history_tokens = assemble_history(history, min(history_token_budget, max(0, available // 2)))
+    context, context_tokens = assemble_context(docs, available - history_tokens)
+    prompt_tokens = prompt_token_budget - available + history_tokens + context_tokens
 
     try:
         logger.info(f"Generating response for query: {query[:50]}... with {len(history)} history entries")
-        chain = prompt | llm
-        response = chain.invoke({
+        chain = prompt | chat_model()
+        inputs = {
             "history": history_text,
             "context": context,
             "question": query
-        }).content.strip()
+        }
+        record_stage("prompt", prompt_start, time.perf_counter() - prompt_start)
+        with metrics.in_progress("exam_llm_requests_in_flight", operation="answer"):
+            if on_token:
+                parts = []
+                start = time.perf_counter()
+                for chunk in chain.stream(inputs):
+                    if chunk.content:
+                        # Don't stream leading whitespace that strip() would drop from the final answer
+                        token = chunk.content if parts else chunk.content.lstrip()
+                        if token:
+                            if not parts:
+                                record_stage("first_token", start, time.perf_counter() - start)
+                            parts.append(token)
+                            on_token(token)
+                response = "".join(parts).strip()
+            else:
+                response = chain.invoke(inputs).content.strip()
+        record_tokens("answer", prompt_tokens, response)
 
         # Add a reference to the conversation context if appropriate
         if history and not "previous" in response.lower() and not "earlier" in response.lower():
             # Check if this question is related to previous ones
             if any(is_related_query(query, hist_query) for hist_query, _ in history[-max_history:]):
-                response += "\n\n(Note: This answer takes into account our previous conversation context.)"
+                note = "\n\n(Note: This answer takes into account our previous conversation context.)"
+                response += note
+                if on_token:
+                    on_token(note)
 
         logger.info(f"Response generated successfully")
         return response
+    except QueryCancelled:
+        raise
     except Exception as e:
         logger.error(f"Error generating response: {e}")
-        return "Sorry, I couldn't generate a response due to a technical issue. Please try again or rephrase your question."
+        return response_error_message
 
 def is_related_query(current_query, previous_query):
     """Check if the current query is related to a previous one using simple heuristics."""
@@ -305,25 +2307,788 @@ def is_related_query(current_query, previous_query):
     common_significant_words = current_words.intersection(previous_words)
     return len(common_significant_words) >= 2
 
+def is_history_independent(query, history):
+    """Check whether a query can be answered without the conversation history."""
+    # Pronoun references ("what is the fee for it?") depend on earlier turns
+    if is_related_query(query, ""):
+        return False
+    return not any(is_related_query(query, hist_query) for hist_query, _ in history[-max_history:])
+
+class AnswerCache:
+    """Semantic cache of answers, matched by cosine similarity of query embeddings.
+
+    Embeddings are kept normalized in one preallocated matrix so a lookup is a single
+    matrix-vector product. Entries expire after ttl seconds and are evicted LRU-first.
+    """
+
+    def __init__(self, embedding_function, threshold=0.97, ttl=3600, max_entries=1000):
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Drop all cached answers, e.g. after the index is rebuilt."""
+        with self._lock:
+            self._vectors = None
+            self._active = np.zeros(self.max_entries, dtype=bool)
+            self._entries = [None] * self.max_entries
+            self._lru = OrderedDict()  # slot -> None, least recently used first
+        logger.info("Answer cache cleared")
+
+    def _embed(self, query):
+        vector = np.asarray(self.embedding_function.embed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staged("answer_cache")
+    def lookup(self, query):
+        """Return the cached entry for the most similar past query above the threshold, or None."""
+        vector = self._embed(query)
+        now = time.time()
+        with self._lock:
+            if self._vectors is None or not self._lru:
+                self.misses += 1
+                return None
+            similarities = np.where(self._active, self._vectors @ vector, -np.inf)
+            slot = int(np.argmax(similarities))
+            entry = self._entries[slot]
+            if similarities[slot] < self.threshold or entry is None:
+                self.misses += 1
+                return None
+            if now - entry["created"] > self.ttl:
+                self._evict(slot)
+                self.misses += 1
+                return None
+            self._lru.move_to_end(slot)
+            self.hits += 1
+            logger.info(f"Answer cache hit (similarity {similarities[slot]:.3f}) for: {query[:50]}...")
+            return dict(entry, similarity=float(similarities[slot]))
+
+    def put(self, query, response, docs):
+        """Cache an answer and the documents it was generated from."""
+        vector = self._embed(query)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            if len(self._lru) >= self.max_entries:
+                self._evict(next(iter(self._lru)))
+            slot = int(np.argmin(self._active))
+            self._vectors[slot] = vector
+            self._active[slot] = True
+            self._entries[slot] = {"query": query, "response": response, "docs": docs, "created": time.time()}
+            self._lru[slot] = None
+
+    def _evict(self, slot):
+        self._active[slot] = False
+        self._entries[slot] = None
+        self._lru.pop(slot, None)
+
+class MemorySessionStore:
+    """Chat histories kept in process memory, for a single worker.
+
+    Sessions idle for ttl seconds expire and past max_sessions the least recently used one is
+    dropped, so connections that never disconnect cleanly don't accumulate.
+    """
+
+    def __init__(self, ttl, max_sessions):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session_id -> (last_used, entries), least recently used first
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._sessions:
+            last_used, _ = next(iter(self._sessions.values()))
+            if now - last_used < self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            self._sessions.popitem(last=False)
+
+    def history(self, session_id):
+        """Return the session's exchanges, oldest first, as {"query", "response", "timestamp"} dicts."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if session_id not in self._sessions:
+                return []
+            entries = self._sessions.pop(session_id)[1]
+            self._sessions[session_id] = (now, entries)
+            return list(entries)
+
+    def append(self, session_id, query, response, timestamp, keep):
+        """Record an exchange, keeping only the session's last keep entries."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entries = self._sessions.pop(session_id, (now, []))[1]
+            entries = (entries + [{"query": query, "response": response, "timestamp": timestamp}])[-keep:]
+            self._sessions[session_id] = (now, entries)
+            self._expire(now)
+
+    def clear(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+class SqliteSessionStore:
+    """Chat histories in a SQLite file, shared by the worker processes on one host.
+
+    Expired and least recently used sessions are purged at most once per purge_interval seconds
+    by each process; reads ignore sessions that expired since.
+    """
+
+    def __init__(self, path, ttl, max_sessions, purge_interval=60):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.purge_interval = purge_interval
+        self._next_purge = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_sessions (session_id TEXT PRIMARY KEY, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chat_sessions_last_used ON chat_sessions (last_used)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, "
+            "query TEXT NOT NULL, response TEXT NOT NULL, timestamp REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chat_messages_session ON chat_messages (session_id, id)")
+        self._conn.commit()
+
+    def _live(self, session_id, now):
+        row = self._conn.execute("SELECT last_used FROM chat_sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row is not None and now - row[0] < self.ttl
+
+    def history(self, session_id):
+        now = time.time()
+        with self._lock:
+            if not self._live(session_id, now):
+                return []
+            self._conn.execute("UPDATE chat_sessions SET last_used = ? WHERE session_id = ?", (now, session_id))
+            rows = self._conn.execute(
+                "SELECT query, response, timestamp FROM chat_messages WHERE session_id = ? ORDER BY id", (session_id,)
+            ).fetchall()
+            self._conn.commit()
+        return [{"query": query, "response": response, "timestamp": timestamp} for query, response, timestamp in rows]
+
+    def append(self, session_id, query, response, timestamp, keep):
+        now = time.time()
+        with self._lock:
+            if not self._live(session_id, now):
+                self._conn.execute("DELETE FROM chat_messages WHERE session_id = ?", (session_id,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_sessions (session_id, last_used) VALUES (?, ?)", (session_id, now)
+            )
+            self._conn.execute(
+                "INSERT INTO chat_messages (session_id, query, response, timestamp) VALUES (?, ?, ?, ?)",
+                (session_id, query, response, timestamp)
+            )
+            self._conn.execute(
+                "DELETE FROM chat_messages WHERE session_id = ? AND id NOT IN "
+                "(SELECT id FROM chat_messages WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                (session_id, session_id, keep)
+            )
+            if now >= self._next_purge:
+                self._purge(now)
+            self._conn.commit()
+
+    def _purge(self, now):
+        self._next_purge = now + self.purge_interval
+        expired = self._conn.execute("DELETE FROM chat_sessions WHERE last_used < ?", (now - self.ttl,)).rowcount
+        excess = self._conn.execute("SELECT COUNT(*) FROM chat_sessions").fetchone()[0] - self.max_sessions
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM chat_sessions WHERE session_id IN "
+                "(SELECT session_id FROM chat_sessions ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+        if expired or excess > 0:
+            self._conn.execute(
+                "DELETE FROM chat_messages WHERE session_id NOT IN (SELECT session_id FROM chat_sessions)"
+            )
+            logger.info(f"Session store purged {expired} expired and {max(excess, 0)} least recently used sessions")
+
+    def clear(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM chat_messages WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+class RedisSessionStore:
+    """Chat histories in Redis or a Redis-compatible server, shared by workers on any host.
+
+    Each session is a list that expires ttl seconds after its last use. There is no session count
+    cap; configure a maxmemory policy such as volatile-lru on the server instead.
+    """
+
+    def __init__(self, url, ttl, prefix="chat_history:"):
+        import redis  # Only needed for this store
+        self.ttl = max(1, int(ttl))
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def history(self, session_id):
+        key = self.prefix + session_id
+        values, _ = self._client.pipeline().lrange(key, 0, -1).expire(key, self.ttl).execute()
+        return [json.loads(value) for value in values]
+
+    def append(self, session_id, query, response, timestamp, keep):
+        key = self.prefix + session_id
+        entry = json.dumps({"query": query, "response": response, "timestamp": timestamp})
+        self._client.pipeline().rpush(key, entry).ltrim(key, -keep, -1).expire(key, self.ttl).execute()
+
+    def clear(self, session_id):
+        self._client.delete(self.prefix + session_id)
+
+def create_session_store():
+    """Build the chat history store selected by SESSION_STORE."""
+    if session_store_backend == "redis":
+        return RedisSessionStore(session_store_url, session_ttl)
+    if session_store_backend == "sqlite":
+        return SqliteSessionStore(session_store_path, session_ttl, session_max_entries)
+    return MemorySessionStore(session_ttl, session_max_entries)
+
 # Global variables to store state
-summary_store = None
-chunk_store = None
-chat_history = {}  # Dictionary to store chat history for each session
+document_shards = {}  # doc_id -> DocumentShard, registered by load_document_shards
+document_store = None  # Document summary collection used to route queries, built by index_document_summaries
+retrieval_executor = ThreadPoolExecutor(max_workers=retrieval_max_workers, thread_name_prefix="retrieval")
+# Blocking query work runs in these pools so Socket.IO handlers stay responsive; the LLM pool
+# size is the global limit on concurrent answer generations
+query_executor = ThreadPoolExecutor(max_workers=query_max_workers, thread_name_prefix="query")
+llm_executor = ThreadPoolExecutor(max_workers=llm_max_concurrency, thread_name_prefix="llm")
+session_store = create_session_store()  # Chat history of each Socket.IO session
+answer_cache = AnswerCache(
+    query_batcher,
+    threshold=answer_cache_threshold,
+    ttl=answer_cache_ttl,
+    max_entries=answer_cache_max_entries
+)
+
+class PdfDocumentClosed(Exception):
+    """Raised by PdfDocument.handle() once the file has changed; fetch the current version from pdf_documents."""
+
+class PdfDocument:
+    """One version of a PDF file: cached page count, TOC and search index, plus a pool of open handles.
+
+    PyMuPDF documents are not thread-safe, so each handle is used by one request at a time.
+    """
+
+    def __init__(self, path, pdf_hash, pool_size):
+        self.path = path
+        self.pdf_hash = pdf_hash
+        self.pool_size = pool_size
+        self.closed = False
+        self._pool = queue.LifoQueue()
+        self._open_handles = 0
+        self._lock = threading.Lock()
+        self._search_index = None
+        self._index_lock = threading.Lock()
+        with self.handle() as doc:
+            self.page_count = len(doc)
+            self.toc = doc.get_toc()
+
+    @contextmanager
+    def handle(self):
+        """Borrow an open fitz.Document, opening a new one if the pool is not yet full.
+
+        Raises PdfDocumentClosed if this version was closed, and TimeoutError if no handle is
+        returned within pdf_handle_timeout seconds.
+        """
+        if self.closed:
+            raise PdfDocumentClosed(self.path)
+        doc = None
+        try:
+            doc = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._open_handles < self.pool_size:
+                    self._open_handles += 1
+                    doc = fitz.open(self.path)
+            if doc is None:
+                try:
+                    doc = self._pool.get(timeout=pdf_handle_timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No free handle of {self.path} after {pdf_handle_timeout:g}s") from None
+        if doc is None:
+            self._pool.put(None)  # Pass close()'s wake-up on to the next waiting thread
+            raise PdfDocumentClosed(self.path)
+        try:
+            yield doc
+        finally:
+            if self.closed:
+                doc.close()
+            else:
+                self._pool.put(doc)
+
+    def search_index(self):
+        """Positional search index for this version, loaded from or persisted next to the Chroma DB."""
+        with self._lock:
+            if self._search_index is not None:
+                return self._search_index
+        with self._index_lock:
+            if self._search_index is None:
+                index_path = os.path.join(persist_directory, f"search_index_{self.pdf_hash[:16]}.json.gz")
+                try:
+                    self._search_index = PdfSearchIndex.load(index_path)
+                    logger.info(f"Loaded PDF search index from {index_path}")
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    logger.warning(f"Could not load PDF search index {index_path}: {e}. Rebuilding...")
+                if self._search_index is None:
+                    start_time = time.time()
+                    with self.handle() as doc:
+                        self._search_index = PdfSearchIndex.build(doc)
+                    logger.info(f"Built PDF search index for {self.page_count} pages in {time.time() - start_time:.2f}s")
+                    try:
+                        os.makedirs(persist_directory, exist_ok=True)
+                        self._search_index.save(index_path)
+                        # Drop indexes of previous versions of the PDF
+                        for entry in os.scandir(persist_directory):
+                            if entry.name.startswith("search_index_") and entry.path != index_path:
+                                os.remove(entry.path)
+                    except OSError as e:
+                        logger.warning(f"Could not persist PDF search index: {e}")
+            return self._search_index
+
+    def close(self):
+        """Close pooled handles; handles still in use are closed when they are returned.
+
+        Threads waiting for a handle are woken and get PdfDocumentClosed.
+        """
+        self.closed = True
+        while True:
+            try:
+                doc = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            if doc is not None:
+                doc.close()
+        self._pool.put(None)
+
+class PdfSearchIndex:
+    """Positional inverted index over the words of a PDF, with word rectangles for highlighting.
+
+    Words are normalized (lowercased, surrounding punctuation stripped). Postings map each word to
+    (page, position) pairs, and a sorted vocabulary allows prefix lookups with bisect. Compound
+    words such as "re-evaluation" are also posted under their parts, so "evaluation" finds them.
+    """
+
+    format_version = 1
+    _strip_chars = string.punctuation + "\u201c\u201d\u2018\u2019"
+    _part_separators = re.compile(r"[\W_]+")
+
+    def __init__(self, pages):
+        self.pages = pages  # [{"words": [...], "rects": [[x0, y0, x1, y1], ...], "lines": [...]}]
+        self.postings = {}
+        for page_num, page in enumerate(pages):
+            for position, word in enumerate(page["words"]):
+                for form in self.forms(word):
+                    self.postings.setdefault(form, []).append((page_num, position))
+        self.vocabulary = sorted(self.postings)
+
+    @classmethod
+    def forms(cls, word):
+        """The word followed by the parts of a hyphenated or otherwise compound word."""
+        parts = [part for part in cls._part_separators.split(word) if part]
+        return list(dict.fromkeys([word] + parts)) if len(parts) > 1 else [word]
+
+    @classmethod
+    def normalize(cls, word):
+        return word.strip(cls._strip_chars).lower()
+
+    @classmethod
+    def build(cls, doc):
+        """Build the index from an open fitz.Document."""
+        pages = []
+        for page in doc:
+            words, rects, lines = [], [], []
+            for x0, y0, x1, y1, text, block_no, line_no, _ in page.get_text("words"):
+                word = cls.normalize(text)
+                if word:
+                    words.append(word)
+                    rects.append([round(x0, 2), round(y0, 2), round(x1, 2), round(y1, 2)])
+                    lines.append(block_no * 10000 + line_no)
+            pages.append({"words": words, "rects": rects, "lines": lines})
+        return cls(pages)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format_version") != cls.format_version:
+            raise ValueError(f"Unsupported search index format: {data.get('format_version')}")
+        return cls(data["pages"])
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump({"format_version": self.format_version, "pages": self.pages}, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def _matching_words(self, term, prefix):
+        if not prefix:
+            return [term] if term in self.postings else []
+        matches = []
+        i = bisect_left(self.vocabulary, term)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(term):
+            matches.append(self.vocabulary[i])
+            i += 1
+        return matches
+
+    def search(self, query, mode="phrase", prefix=True):
+        """Search the index and return [{'page_num', 'count', 'rects'}] like page.search_for results.
+
+        mode "phrase" matches the terms as consecutive words; "all" and "any" match pages containing
+        all or any of the terms. With prefix, each term also matches words starting with it.
+        """
+        terms = [term for term in (self.normalize(word) for word in query.split()) if term]
+        if not terms:
+            return []
+        matches = {}  # page_num -> list of (start, end) word spans
+
+        if mode == "phrase":
+            def term_matches(word, term):
+                return any(form.startswith(term) if prefix else form == term for form in self.forms(word))
+            for word in self._matching_words(terms[0], prefix):
+                for page_num, position in self.postings[word]:
+                    words = self.pages[page_num]["words"]
+                    end = position + len(terms)
+                    if end <= len(words) and all(term_matches(words[position + j], terms[j]) for j in range(1, len(terms))):
+                        matches.setdefault(page_num, []).append((position, end))
+        else:
+            term_pages = []
+            for term in terms:
+                positions = {}
+                for word in self._matching_words(term, prefix):
+                    for page_num, position in self.postings[word]:
+                        positions.setdefault(page_num, []).append((position, position + 1))
+                term_pages.append(positions)
+            page_sets = [set(positions) for positions in term_pages]
+            pages = set.intersection(*page_sets) if mode == "all" else set.union(*page_sets)
+            for page_num in pages:
+                matches[page_num] = [span for positions in term_pages for span in positions.get(page_num, [])]
+
+        results = []
+        for page_num in sorted(matches):
+            page = self.pages[page_num]
+            # A compound word is posted under itself and its parts, which may all match one term
+            spans = sorted(set(matches[page_num]))
+            rects = []
+            for start, end in spans:
+                # One rectangle per line the match spans
+                line = None
+                for i in range(start, end):
+                    x0, y0, x1, y1 = page["rects"][i]
+                    if page["lines"][i] == line:
+                        rect = rects[-1]
+                        rect.update(x0=min(rect['x0'], x0), y0=min(rect['y0'], y0), x1=max(rect['x1'], x1), y1=max(rect['y1'], y1))
+                    else:
+                        rects.append({'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1})
+                        line = page["lines"][i]
+            results.append({'page_num': page_num, 'count': len(spans), 'rects': rects})
+        return results
+
+class PdfDocumentManager:
+    """Keeps one PdfDocument per path, reopening it when the file's mtime/size and hash change."""
+
+    def __init__(self, pool_size=4):
+        self.pool_size = pool_size
+        self._documents = {}  # path -> (mtime_ns, size, PdfDocument)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return the current PdfDocument for path. Raises FileNotFoundError if it is missing."""
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._documents.get(path)
+            if entry and entry[:2] == (stat.st_mtime_ns, stat.st_size) and not entry[2].closed:
+                return entry[2]
+            # File touched or replaced: only reopen if the content actually changed
+            pdf_hash = file_sha256(path)
+            if entry and entry[2].pdf_hash == pdf_hash and not entry[2].closed:
+                document = entry[2]
+            else:
+                if entry:
+                    logger.info(f"PDF {path} changed on disk. Reloading document.")
+                    entry[2].close()
+                document = PdfDocument(path, pdf_hash, self.pool_size)
+                logger.info(f"Opened PDF {path}: {document.page_count} pages")
+            self._documents[path] = (stat.st_mtime_ns, stat.st_size, document)
+            return document
+
+    def use(self, path, fn):
+        """fn(current PdfDocument for path), retried once with the new version if the file changed meanwhile."""
+        try:
+            return fn(self.get(path))
+        except PdfDocumentClosed:
+            return fn(self.get(path))
+
+pdf_documents = PdfDocumentManager(pdf_handle_pool_size)
+
+class RenderedPageCache:
+    """Two-level cache of rendered page images keyed by (PDF hash, page, zoom, format).
+
+    Images are kept in a byte-bounded in-memory LRU and written to disk under
+    cache_dir/<pdf hash>/, which is trimmed oldest-first once it exceeds disk_bytes.
+    """
+
+    def __init__(self, cache_dir, memory_bytes, disk_bytes):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        pdf_hash, page_num, zoom, fmt = key
+        return os.path.join(self.cache_dir, pdf_hash, f"{page_num}_{zoom:g}.{fmt}")
+
+    def _remember(self, key, data):
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        with self._lock:
+            self._remember(key, data)
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._remember(key, data)
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._trim_disk(len(data))
+        except OSError as e:
+            logger.warning(f"Could not write page cache file {path}: {e}")
+
+    def _trim_disk(self, added):
+        with self._lock:
+            if self._disk_size is None:
+                self._disk_size = sum(entry.stat().st_size for entry in self._scan())
+            else:
+                self._disk_size += added
+            if self._disk_size <= self.disk_bytes:
+                return
+            entries = sorted(self._scan(), key=lambda entry: entry.stat().st_mtime)
+            target = int(self.disk_bytes * 0.9)
+            for entry in entries:
+                if self._disk_size <= target:
+                    break
+                size = entry.stat().st_size
+                try:
+                    os.remove(entry.path)
+                    self._disk_size -= size
+                except OSError:
+                    pass
+
+    def _scan(self):
+        for pdf_dir in os.scandir(self.cache_dir):
+            if pdf_dir.is_dir():
+                yield from (entry for entry in os.scandir(pdf_dir.path) if entry.is_file())
+
+page_cache = RenderedPageCache(page_cache_directory, page_cache_memory_bytes, page_cache_disk_bytes)
+
+def parse_zoom(value, default):
+    """Snap a requested zoom to the nearest allowed render zoom."""
+    try:
+        zoom = float(value) if value is not None else default
+    except ValueError:
+        zoom = default
+    return min(page_zoom_levels, key=lambda level: abs(level - zoom))
+
+@staged("page_render")
+def render_page_image(page_num, zoom, fmt):
+    """Return (image bytes, pdf hash) for a page, rendering it only on a cache miss.
+
+    Raises IndexError if page_num is out of range.
+    """
+    def render(document):
+        key = (document.pdf_hash, page_num, zoom, fmt)
+        data = page_cache.get(key)
+        if data is not None:
+            return data, document.pdf_hash
+
+        if not 0 <= page_num < document.page_count:
+            raise IndexError("Page number out of range")
+        with document.handle() as doc:
+            pix = doc[page_num].get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        if fmt == "webp":
+            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            buffer = BytesIO()
+            image.save(buffer, format="WEBP", quality=85)
+            data = buffer.getvalue()
+        else:
+            data = pix.tobytes("png")
+        page_cache.put(key, data)
+        return data, document.pdf_hash
+
+    return pdf_documents.use(pdf_path, render)
+
+def page_image_url(page_num, zoom, fmt="png"):
+    """Versioned URL for a page image; the version lets browsers cache it indefinitely."""
+    return f"/pdf/{page_num}/image?zoom={zoom:g}&format={fmt}&v={pdf_documents.get(pdf_path).pdf_hash[:16]}"
+
+def prerender_thumbnails():
+    """Render every page thumbnail into the page cache, yielding between pages."""
+    if not os.path.exists(pdf_path):
+        return
+    try:
+        start_time = time.time()
+        total_pages = pdf_documents.get(pdf_path).page_count
+        for page_num in range(total_pages):
+            render_page_image(page_num, thumbnail_zoom, "png")
+            socketio.sleep(0)  # Don't starve request handlers
+        logger.info(f"Pre-rendered {total_pages} thumbnails in {time.time() - start_time:.1f}s")
+    except Exception as e:
+        logger.error(f"Error pre-rendering thumbnails: {e}")
 
 # Flask routes
+@app.before_request
+def ensure_warm_up():
+    """Start the background warm-up with the first request (e.g. under a WSGI server)."""
+    start_warm_up()
+
 @app.route('/')
 def index():
     """Render the main page."""
     return render_template('index.html')
 
+@app.before_request
+def start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_start = time.perf_counter()
+    metrics.inc("exam_http_requests_in_flight", route=g.metrics_route)
+
+@app.after_request
+def record_request_metrics(response):
+    if "metrics_start" in g:
+        metrics.observe("exam_http_request_duration_seconds", time.perf_counter() - g.metrics_start, route=g.metrics_route)
+        metrics.inc("exam_http_requests_total", route=g.metrics_route, status=str(response.status_code))
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if "metrics_start" in g:
+        metrics.inc("exam_http_requests_in_flight", -1, route=g.metrics_route)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics in the text exposition format."""
+    return make_response(metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process serves requests."""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: 200 once queries can be answered, 503 while warming up or after a failed start."""
+    state = dict(warm_up_state)
+    return jsonify(state), 200 if state['status'] == 'ready' else 503
+
+def admin_only(fn):
+    """Serve an /admin endpoint only when ADMIN_TOKEN is set and sent in the X-Admin-Token header."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not admin_token:
+            return jsonify({'status': 'error', 'message': 'Not found'}), 404
+        if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), admin_token):
+            return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+        return fn(*args, **kwargs)
+    return wrapper
+
+@app.route('/admin/traces')
+@admin_only
+def get_slow_traces():
+    """The slowest recent query traces (over TRACE_SLOW_MS), slowest first."""
+    limit = min(tracer.slow.maxlen, max(1, request.args.get('limit', 20, type=int)))
+    return jsonify({
+        'status': 'success',
+        'threshold_ms': trace_slow_ms,
+        'traces': [trace.to_dict() for trace in tracer.slowest(limit)]
+    })
+
+@app.route('/admin/traces/<request_id>')
+@admin_only
+def get_trace(request_id):
+    """One recent trace by the request ID sent to the client."""
+    trace = tracer.find(request_id)
+    if trace is None:
+        return jsonify({'status': 'error', 'message': 'Trace not found'}), 404
+    return jsonify({'status': 'success', 'trace': trace.to_dict()})
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+@admin_only
+def profile_control():
+    """Profile the next N queries ({"queries": N}) or a document sync run ({"ingestion": true}).
+
+    Query profiles are folded stack samples of the threads working on the query
+    (query-<request_id>.folded); ingestion profiles sample all threads (ingestion-<time>.folded).
+    Both are written to PROFILE_DIR.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if 'queries' in data:
+            profiler.profile_queries(max(0, int(data['queries'])))
+        if data.get('ingestion'):
+            if warm_up_state['ingesting'] or profiler.ingestion_running or not index_ready.is_set():
+                return jsonify({'status': 'error', 'message': 'Ingestion is already running or start-up has not finished'}), 409
+
+            def profiled_sync():
+                try:
+                    profiler.run_ingestion(initialize_rag_system)
+                finally:
+                    warm_up_state['ingesting'] = False
+
+            warm_up_state['ingesting'] = True
+            threading.Thread(target=profiled_sync, daemon=True, name="profiled-ingestion").start()
+    return jsonify({
+        'status': 'success',
+        'queries_remaining': profiler.remaining_queries,
+        'ingestion_running': profiler.ingestion_running,
+        'directory': profiler.directory,
+        'files': profiler.files()
+    })
+
 @app.route('/pdf')
 def get_pdf_info():
     """Get PDF information."""
     if os.path.exists(pdf_path):
         try:
-            doc = fitz.open(pdf_path)
-            total_pages = len(doc)
-            doc.close()
+            total_pages = pdf_documents.get(pdf_path).page_count
             return jsonify({
                 'status': 'success',
                 'filename': os.path.basename(pdf_path),
@@ -337,22 +3102,20 @@ def get_pdf_info():
 
 @app.route('/pdf/<int:page_num>')
 def get_pdf_page(page_num):
-    """Get a specific page from the PDF as an image."""
+    """Get a specific page from the PDF as a link to its rendered image."""
     if os.path.exists(pdf_path):
         try:
-            doc = fitz.open(pdf_path)
-            if 0 <= page_num < len(doc):
-                page = doc[page_num]
-                pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-                img_bytes = pix.tobytes("png")
-                doc.close()
+            total_pages = pdf_documents.get(pdf_path).page_count
+            if 0 <= page_num < total_pages:
+                fmt = request.args.get('format', 'png')
+                if fmt not in page_image_formats:
+                    return jsonify({'status': 'error', 'message': f'Unsupported image format: {fmt}'})
                 return jsonify({
                     'status': 'success',
                     'page_num': page_num,
-                    'image_data': f"data:image/png;base64,{img_bytes.decode('latin1')}"
+                    'image_url': page_image_url(page_num, parse_zoom(request.args.get('zoom'), 2.0), fmt)
                 })
             else:
-                doc.close()
                 return jsonify({'status': 'error', 'message': 'Page number out of range'})
         except Exception as e:
             logger.error(f"Error getting PDF page: {e}")
@@ -360,29 +3123,54 @@ def get_pdf_page(page_num):
     else:
         return jsonify({'status': 'error', 'message': 'PDF file not found'})
 
+@app.route('/pdf/<int:page_num>/image')
+def get_pdf_page_image(page_num):
+    """Serve a rendered page as a binary image, from cache when possible."""
+    if not os.path.exists(pdf_path):
+        return jsonify({'status': 'error', 'message': 'PDF file not found'}), 404
+    fmt = request.args.get('format', 'png')
+    if fmt not in page_image_formats or (fmt == 'webp' and not pil_features.check('webp')):
+        return jsonify({'status': 'error', 'message': f'Unsupported image format: {fmt}'}), 400
+    zoom = parse_zoom(request.args.get('zoom'), 2.0)
+    try:
+        data, pdf_hash = render_page_image(page_num, zoom, fmt)
+    except IndexError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 404
+    except Exception as e:
+        logger.error(f"Error rendering PDF page: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    response = make_response(data)
+    response.mimetype = page_image_formats[fmt]
+    response.set_etag(f"{pdf_hash[:16]}-{page_num}-{zoom:g}-{fmt}")
+    if request.args.get('v') == pdf_hash[:16]:
+        # Versioned URLs never change content, so browsers can skip revalidation
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, max-age=300, must-revalidate'
+    return response.make_conditional(request)
+
 @app.route('/pdf/thumbnails')
 def get_pdf_thumbnails():
-    """Get thumbnails for all pages in the PDF."""
+    """Get thumbnail image links for a range of pages (?start=&count=) in the PDF."""
     if os.path.exists(pdf_path):
         try:
-            doc = fitz.open(pdf_path)
-            thumbnails = []
-
-            # Generate thumbnails for the first 20 pages (to avoid too much data)
-            max_pages = min(20, len(doc))
-            for i in range(max_pages):
-                page = doc[i]
-                pix = page.get_pixmap(matrix=fitz.Matrix(0.2, 0.2))  # Small thumbnail
-                img_bytes = pix.tobytes("png")
-                thumbnails.append({
-                    'page_num': i,
-                    'image_data': f"data:image/png;base64,{img_bytes.decode('latin1')}"
-                })
+            total_pages = pdf_documents.get(pdf_path).page_count
+            start = max(0, request.args.get('start', 0, type=int))
+            count = min(100, max(1, request.args.get('count', thumbnail_page_size, type=int)))
+            end = min(start + count, total_pages)
 
-            doc.close()
+            # Images are pre-rendered in the background, or rendered and cached when first fetched
+            thumbnails = [
+                {'page_num': i, 'image_url': page_image_url(i, thumbnail_zoom)}
+                for i in range(start, end)
+            ]
             return jsonify({
                 'status': 'success',
-                'thumbnails': thumbnails
+                'thumbnails': thumbnails,
+                'start': start,
+                'total_pages': total_pages,
+                'next_start': end if end < total_pages else None
             })
         except Exception as e:
             logger.error(f"Error generating thumbnails: {e}")
@@ -395,9 +3183,7 @@ def get_pdf_outline():
     """Get the outline/table of contents of the PDF."""
     if os.path.exists(pdf_path):
         try:
-            doc = fitz.open(pdf_path)
-            toc = doc.get_toc()
-            doc.close()
+            toc = pdf_documents.get(pdf_path).toc
 
             # Format the TOC for easier consumption
             outline = []
@@ -421,32 +3207,23 @@ def get_pdf_outline():
 
 @app.route('/pdf/search')
 def search_pdf():
-    """Search for text in the PDF."""
+    """Search for text in the PDF using the prebuilt positional index."""
     query = request.args.get('query', '')
     if not query:
         return jsonify({'status': 'error', 'message': 'No search query provided'})
+    mode = request.args.get('mode', 'phrase')
+    if mode not in ('phrase', 'all', 'any'):
+        return jsonify({'status': 'error', 'message': f'Unsupported search mode: {mode}'})
+    prefix = request.args.get('prefix', 'true').lower() != 'false'
 
     if os.path.exists(pdf_path):
         try:
-            doc = fitz.open(pdf_path)
-            results = []
-
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                text_instances = page.search_for(query)
-
-                if text_instances:
-                    results.append({
-                        'page_num': page_num,
-                        'count': len(text_instances),
-                        'rects': [{'x0': rect[0], 'y0': rect[1], 'x1': rect[2], 'y1': rect[3]}
-                                 for rect in text_instances]
-                    })
-
-            doc.close()
+            index = pdf_documents.use(pdf_path, lambda document: document.search_index())
+            results = index.search(query, mode=mode, prefix=prefix)
             return jsonify({
                 'status': 'success',
                 'query': query,
+                'mode': mode,
                 'results': results,
                 'total_matches': sum(r['count'] for r in results)
             })
@@ -456,24 +3233,443 @@ def search_pdf():
     else:
         return jsonify({'status': 'error', 'message': 'PDF file not found'})
 
+def load_corpus_shards(directory):
+    """Shards for the examination manual and every other PDF in the corpus directory."""
+    shards = [primary_shard] if os.path.exists(pdf_path) else []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.lower().endswith(".pdf") and os.path.realpath(path) != os.path.realpath(pdf_path):
+            shards.append(DocumentShard.for_corpus_file(path))
+    return shards
+
+def load_document_shards():
+    """Register the documents to serve and open their stores, so committed chunks are searchable at once."""
+    shards = load_corpus_shards(corpus_directory) if corpus_directory else [primary_shard]
+    for shard in shards:
+        shard.summary_store, shard.chunk_store = load_stores(shard)
+        document_shards[shard.doc_id] = shard
+    logger.info(f"Serving {len(shards)} document(s): {', '.join(shard.title for shard in shards)}")
+
+def summarize_document(title, summaries, doc_id):
+    """Summary of a whole document from its chunk summaries, or None if it failed.
+
+    A summary request only reads summary_input_chars characters, so the chunk summaries are packed
+    into groups that fit one request and each group is summarized; the group summaries are then
+    grouped again, until one request covers the whole document.
+    """
+    level = 0
+    while True:
+        texts = [text for text in summaries if text]
+        if sum(len(text) + 1 for text in texts) + len(title) + 2 <= summary_input_chars or len(texts) <= 1:
+            return generate_summary(f"{title}\n\n" + "\n".join(texts), doc_id)
+        groups, group, size = [], [], 0
+        for text in texts:
+            # At least two texts per group, so each round at least halves the number of texts
+            if len(group) >= 2 and size + len(text) + 1 > summary_input_chars:
+                groups.append(group)
+                group, size = [], 0
+            group.append(text)
+            size += len(text) + 1
+        groups.append(group)
+        level += 1
+        summaries = list(ordered_map(
+            lambda item: generate_summary("\n".join(item[1]), f"{doc_id} part {level}.{item[0] + 1}"),
+            enumerate(groups), summary_max_workers
+        ))
+        if any(summary is None for summary in summaries):
+            return None
+
+def index_document_summaries(shards):
+    """Summarize each document from its chunk summaries and index the summaries for query routing."""
+    global document_store
+    texts, metadatas, ids = [], [], []
+    for shard in shards:
+        if not shard.chunk_map:
+            continue
+        manifest = load_manifest(shard.manifest_path) or {}
+        summary = manifest.get("document_summary")
+        if not summary:
+            chunks = sorted(shard.chunk_map.values(), key=lambda chunk: chunk["metadata"].get("index", 0))
+            summary = summarize_document(shard.title, [chunk["summary"] for chunk in chunks if chunk["summary"]], shard.doc_id)
+            if manifest.get("status") == "complete" and summary is not None:
+                manifest["document_summary"] = summary
+                save_manifest(manifest, shard.manifest_path)
+        texts.append(f"{shard.title}\n{summary or ''}")
+        metadatas.append({"document": shard.doc_id, "title": shard.title})
+        ids.append(shard.doc_id)
+    store = store_texts(document_collection_name, texts, metadatas, ids) if ids else open_store(document_collection_name)
+    stale_ids = list(set(store._collection.get(include=[])["ids"]) - set(ids))
+    if stale_ids:
+        store._collection.delete(ids=stale_ids)
+    flush_stores(store)
+    document_store = store
+    logger.info(f"Indexed {len(ids)} document summaries for query routing")
+
+def ingest_corpus(shards, max_workers=None):
+    """Sync every document's stores concurrently, then refresh the document routing index."""
+    max_workers = max_workers or corpus_max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_document, shard.pdf_path, shard=shard): shard for shard in shards}
+        for future in as_completed(futures):
+            count, _, _ = future.result()
+            logger.info(f"Ingested {futures[future].title}: {count} chunks")
+    index_document_summaries(shards)
+
+def sync_documents():
+    """Sync the registered documents' vector stores with their PDFs."""
+    if corpus_directory:
+        ingest_corpus(list(document_shards.values()))
+    else:
+        process_document(pdf_path)
+
+def initialize_rag_system():
+    """Sync the vector stores with the PDFs; handlers already search the shards' committed chunks."""
+    try:
+        sync_documents()
+        logger.info("RAG system initialized successfully")
+    except Exception as e:
+        logger.error(f"Error initializing RAG system: {e}")
+
+class IndexSnapshot:
+    """Portable, read-only copy of the ingested documents in one file, memory-mapped.
+
+    Layout: magic, format version and header length (struct "<8sII"), a JSON header, then the
+    body at a 64-byte aligned offset. The header records the embedding model and chunking
+    settings, the SHA-256 of the body, and per document its PDF hash and where its chunk and
+    summary embeddings (float32 matrices), its JSON records (chunk text, summary, metadata) and
+    the embedding of its routing summary sit in the body. Matrices are read in place from the
+    mapping, so drop them before close().
+    """
+
+    magic = b"EXAMIDX\0"
+    format_version = 1
+    prefix = struct.Struct("<8sII")
+    alignment = 64
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, header_length = self.prefix.unpack_from(self._map)
+            if magic != self.magic:
+                raise ValueError(f"{path} is not an index snapshot")
+            if version != self.format_version:
+                raise ValueError(f"Unsupported index snapshot format: {version}")
+            self.header = json.loads(self._map[self.prefix.size:self.prefix.size + header_length])
+            self.body_start = self._aligned(self.prefix.size + header_length)
+            digest = hashlib.sha256()
+            for start in range(self.body_start, len(self._map), 1 << 20):
+                digest.update(self._map[start:start + (1 << 20)])
+            if digest.hexdigest() != self.header.get("body_sha256"):
+                raise ValueError(f"Index snapshot {path} is corrupt (checksum mismatch)")
+        except struct.error:
+            self.close()
+            raise ValueError(f"Index snapshot {path} is truncated")
+        except Exception:
+            self.close()
+            raise
+
+    @classmethod
+    def _aligned(cls, offset):
+        return -(-offset // cls.alignment) * cls.alignment
+
+    @property
+    def documents(self):
+        return self.header["documents"]
+
+    def vectors(self, document, kind):
+        """The float32 "chunk" or "summary" embeddings (chunks x dim), or the "document" one (1 x dim), backed by the mapping."""
+        count, dim = (1 if kind == "document" else document["count"]), self.header["dimensions"]
+        return np.frombuffer(self._map, dtype="<f4", count=count * dim,
+                             offset=self.body_start + document[f"{kind}_vectors"]).reshape(count, dim)
+
+    def records(self, document):
+        """[{"id", "text", "summary", "metadata"}] of a document, in document order."""
+        offset, length = document["records"]
+        start = self.body_start + offset
+        return json.loads(self._map[start:start + length])
+
+    def close(self):
+        if getattr(self, "_map", None) is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    @classmethod
+    def write(cls, path, shards):
+        """Write a snapshot of the shards' committed chunks, summaries and embeddings; returns its header."""
+        documents, parts, body_length = [], [], 0
+
+        def add(data):
+            nonlocal body_length
+            offset = body_length
+            padding = cls._aligned(len(data)) - len(data)
+            parts.append(data + b"\0" * padding)
+            body_length += len(data) + padding
+            return offset
+
+        dimensions = None
+        for shard in shards:
+            manifest = load_manifest(shard.manifest_path) or {}
+            if manifest.get("status") != "complete" or not shard.chunk_map:
+                logger.warning(f"Skipping {shard.doc_id} in the snapshot: its ingestion is not complete")
+                continue
+            ids = sorted(shard.chunk_map, key=lambda chunk_id: shard.chunk_map[chunk_id]["metadata"].get("index", 0))
+            matrices = {}
+            for kind, store in (("chunk", shard.chunk_store), ("summary", shard.summary_store)):
+                stored = store._collection.get(ids=ids, include=["embeddings"])
+                by_id = dict(zip(stored["ids"], stored["embeddings"]))
+                matrices[kind] = np.asarray([by_id[chunk_id] for chunk_id in ids], dtype="<f4")
+            dimensions = dimensions or matrices["chunk"].shape[1]
+            records = [
+                {"id": chunk_id, "text": shard.chunk_map[chunk_id]["text"],
+                 "summary": shard.chunk_map[chunk_id]["summary"], "metadata": shard.chunk_map[chunk_id]["metadata"]}
+                for chunk_id in ids
+            ]
+            document = {
+                "doc_id": shard.doc_id, "title": shard.title, "pdf_name": os.path.basename(shard.pdf_path),
+                "pdf_hash": manifest["pdf_hash"], "count": len(ids),
+                "chunk_size": manifest.get("chunk_size"), "chunk_overlap": manifest.get("chunk_overlap"),
+                "document_summary": manifest.get("document_summary"),
+                "chunk_vectors": add(matrices["chunk"].tobytes()),
+                "summary_vectors": add(matrices["summary"].tobytes())
+            }
+            # The routing summary's embedding, so a corpus replica doesn't embed it again
+            if document_store is not None and document["document_summary"]:
+                stored = document_store._collection.get(ids=[shard.doc_id], include=["embeddings"])
+                if stored["ids"]:
+                    document["document_vectors"] = add(np.asarray(stored["embeddings"][:1], dtype="<f4").tobytes())
+            encoded = json.dumps(records, separators=(",", ":")).encode("utf-8")
+            document["records"] = [add(encoded), len(encoded)]
+            documents.append(document)
+
+        body = b"".join(parts)
+        header = {
+            "created_at": time.time(),
+            "embedding_model": embeddings.model_name,
+            "dimensions": dimensions or 0,
+            "chunker": chunker_version,
+            "body_sha256": hashlib.sha256(body).hexdigest(),
+            "documents": documents
+        }
+        encoded_header = json.dumps(header).encode("utf-8")
+        start = cls._aligned(cls.prefix.size + len(encoded_header))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls.prefix.pack(cls.magic, cls.format_version, len(encoded_header)))
+            f.write(encoded_header)
+            f.write(b"\0" * (start - cls.prefix.size - len(encoded_header)))
+            f.write(body)
+        os.replace(tmp_path, path)
+        return header
+
+def build_snapshot(path):
+    """Sync the stores with the PDFs (ingesting as needed) and write them to an index snapshot."""
+    load_document_shards()
+    sync_documents()
+    header = IndexSnapshot.write(path, list(document_shards.values()))
+    logger.info(f"Wrote index snapshot {path} with {sum(doc['count'] for doc in header['documents'])} chunks "
+                f"from {len(header['documents'])} document(s)")
+
+def restore_snapshot(path):
+    """Fill the vector stores of the registered documents from an index snapshot, without API calls.
+
+    A document is restored only if its PDF still has the hash recorded in the snapshot, and only if
+    its stores aren't already built from that PDF; the others are left to process_document. The
+    manifest and BM25 index are written as ingestion would, so process_document then finds the
+    stores up to date. Returns the IDs of the restored documents.
+    """
+    snapshot = IndexSnapshot(path)
+    try:
+        header = snapshot.header
+        if header["embedding_model"] != embeddings.model_name:
+            raise ValueError(f"Index snapshot uses {header['embedding_model']}, not {embeddings.model_name}")
+        if header["chunker"] != chunker_version:
+            raise ValueError(f"Index snapshot was chunked by chunker version {header['chunker']}, not {chunker_version}")
+        restored = []
+        for document in snapshot.documents:
+            shard = document_shards.get(document["doc_id"])
+            if shard is None:
+                continue
+            pdf_hash = file_sha256(shard.pdf_path) if os.path.exists(shard.pdf_path) else None
+            if pdf_hash != document["pdf_hash"]:
+                logger.warning(f"Not restoring {shard.doc_id} from the snapshot: {shard.pdf_path} has changed")
+                continue
+            with shard.lock:
+                manifest = load_manifest(shard.manifest_path) or {}
+                if manifest.get("status") == "complete" and manifest.get("pdf_hash") == pdf_hash \
+                        and manifest.get("chunker") == chunker_version:
+                    continue
+                summary_store, chunk_store = load_stores(shard)
+                records = snapshot.records(document)
+                ids = [record["id"] for record in records]
+                metadatas = [record["metadata"] for record in records]
+                stale_ids = list((set(chunk_store._collection.get(include=[])["ids"])
+                                  | set(summary_store._collection.get(include=[])["ids"])) - set(ids))
+                if stale_ids:
+                    summary_store._collection.delete(ids=stale_ids)
+                    chunk_store._collection.delete(ids=stale_ids)
+                for kind, store in (("chunk", chunk_store), ("summary", summary_store)):
+                    vectors = snapshot.vectors(document, kind)
+                    try:
+                        for start in range(0, len(ids), snapshot_restore_batch_size):
+                            end = start + snapshot_restore_batch_size
+                            store._collection.upsert(
+                                ids=ids[start:end], embeddings=vectors[start:end].tolist(),
+                                documents=[record[kind if kind == "summary" else "text"] for record in records[start:end]],
+                                metadatas=metadatas[start:end]
+                            )
+                    finally:
+                        del vectors  # Releases the mapping, also when an upsert fails
+                if "document_vectors" in document:
+                    # Seed the embedding cache, so index_document_summaries finds the routing embedding
+                    vector = snapshot.vectors(document, "document")[0].tolist()
+                    embeddings._store([(embeddings._key(f"{shard.title}\n{document['document_summary']}"), vector)])
+                chunk_map = {
+                    record["id"]: {"text": record["text"], "summary": record["summary"], "metadata": record["metadata"]}
+                    for record in records
+                }
+                shard.summary_store, shard.chunk_store, shard.chunk_map = summary_store, chunk_store, chunk_map
+                shard.lexical_index = build_lexical_index(chunk_map, shard.lexical_index_path)
+                shard.sections = build_section_index(chunk_map)
+                flush_stores(summary_store, chunk_store)
+                save_manifest({
+                    "pdf_path": str(shard.pdf_path),
+                    "pdf_hash": pdf_hash,
+                    "chunk_size": document["chunk_size"],
+                    "chunk_overlap": document["chunk_overlap"],
+                    "chunker": chunker_version,
+                    "status": "complete",
+                    "batches": 0,
+                    "stored_chunks": len(ids),
+                    "chunk_ids": ids,
+                    "document_summary": document.get("document_summary"),
+                    "snapshot": {"path": str(path), "created_at": header["created_at"]},
+                    "updated_at": time.time()
+                }, shard.manifest_path)
+            restored.append(shard.doc_id)
+            logger.info(f"Restored {shard.doc_id} from index snapshot {path}: {len(ids)} chunks")
+        if restored:
+            answer_cache.clear()
+        return restored
+    finally:
+        snapshot.close()
+
+# Start-up state reported by /readyz: "starting" -> "warming" -> "ready" or "failed". Ready comes
+# as soon as every document has stored chunks (persisted, restored from a snapshot or from the
+# first committed batch); queries are then answered from the committed chunks while "ingesting"
+# is still true.
+warm_up_state = {
+    "status": "starting", "ingesting": False, "error": None, "started_at": None, "ready_at": None,
+    "documents": {}  # doc_id -> batches and new chunks committed by the current ingestion
+}
+index_ready = threading.Event()
+_warm_up_lock = threading.Lock()
+
+def start_warm_up():
+    """Start warm_up once per process; cheap enough to call on every request."""
+    with _warm_up_lock:
+        if warm_up_state["started_at"] is not None:
+            return
+        warm_up_state["started_at"] = time.time()
+    threading.Thread(target=warm_up, daemon=True, name="warm-up").start()
+    socketio.start_background_task(announce_index_ready)
+    if prerender_thumbnails_enabled:
+        socketio.start_background_task(prerender_thumbnails)
+
+def warm_up():
+    """Open the stores and prime caches off the request path, then sync the PDFs.
+
+    Imports the LangChain/Chroma/OpenAI modules, creates the clients, loads each shard's
+    collections and BM25 index and the PDF search index, so no user request pays for them.
+    """
+    warm_up_state["status"] = "warming"
+    try:
+        openai_options()  # Fail fast on a missing key
+        import langchain.prompts, langchain.text_splitter, langchain_core.documents  # noqa: F401,E401
+        embeddings.underlying
+        chat_model()
+        token_encoder()
+        static_prompt_tokens(answer_template), static_prompt_tokens(summary_template)
+        load_document_shards()
+        if index_snapshot_path:
+            try:
+                restore_snapshot(index_snapshot_path)
+            except Exception as e:
+                logger.error(f"Could not restore index snapshot {index_snapshot_path}: {e}. Ingesting the PDFs instead.")
+        if os.path.exists(pdf_path):
+            pdf_documents.get(pdf_path).search_index()
+    except Exception as e:
+        logger.error(f"Error warming up the RAG system: {e}")
+        warm_up_state.update(status="failed", error=str(e))
+        return
+    warm_up_state["ingesting"] = True
+    if shards_loaded():
+        mark_index_ready()  # Serve the persisted stores while the PDFs are re-checked
+    if profile_ingestion:
+        profiler.run_ingestion(initialize_rag_system)
+    else:
+        initialize_rag_system()
+    warm_up_state["ingesting"] = False
+    if not index_ready.is_set():
+        if shards_loaded(every=False):
+            mark_index_ready()
+        else:
+            warm_up_state.update(status="failed", error="No document could be indexed")
+
+def ingestion_progress(shard, progress):
+    """Report a committed batch on /readyz; the index is ready once every document has chunks stored.
+
+    Committed chunks are searchable, so start-up doesn't wait for the rest of the ingestion.
+    """
+    if not warm_up_state["ingesting"]:
+        return
+    documents = dict(warm_up_state["documents"])
+    documents[shard.doc_id] = {"batches": progress["batches"], "stored_chunks": progress["stored_chunks"]}
+    warm_up_state["documents"] = documents
+    if not index_ready.is_set() and shards_loaded():
+        mark_index_ready()
+
+def shards_loaded(every=True):
+    """Whether every (or, with every=False, any) document shard has chunks in its stores."""
+    loaded = (shard.chunk_store is not None and shard.chunk_store._collection.count() > 0
+              for shard in document_shards.values())
+    return all(loaded) if every else any(loaded)
+
+def mark_index_ready():
+    """Let queries through and report ready on /readyz."""
+    with _warm_up_lock:
+        if index_ready.is_set():
+            return
+        warm_up_state.update(status="ready", ready_at=time.time())
+        index_ready.set()
+    logger.info(f"Index ready {warm_up_state['ready_at'] - warm_up_state['started_at']:.2f}s after start-up")
+
+def announce_index_ready():
+    """Tell connected clients once the index can answer queries."""
+    while warm_up_state["status"] not in ("ready", "failed"):
+        socketio.sleep(0.1)
+    if index_ready.is_set():
+        socketio.emit('index_ready', {'message': 'The assistant is ready.'})
+    else:
+        socketio.emit('error', {'message': f"Error initializing chatbot: {warm_up_state['error']}"})
+
 # Socket.IO events
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection."""
     session_id = request.sid
     logger.info(f"Client connected: {session_id}")
-    chat_history[session_id] = []
+    metrics.inc("exam_connected_sessions")
 
-    # Initialize RAG system
-    global summary_store, chunk_store
-    if summary_store is None or chunk_store is None:
-        try:
-            _, summary_store, chunk_store = process_document(pdf_path)
-            logger.info("RAG system initialized successfully")
-        except Exception as e:
-            logger.error(f"Error initializing RAG system: {e}")
-            emit('error', {'message': f"Error initializing chatbot: {str(e)}"})
-            return
+    # The RAG system is initialized by the background warm-up, never by a client's connection
+    start_warm_up()
+    if warm_up_state["status"] == "failed":
+        emit('error', {'message': f"Error initializing chatbot: {warm_up_state['error']}"})
+        return
+    if not index_ready.is_set():
+        emit('index_warming', {'message': 'The assistant is loading the examination manual. Your questions will be answered in a moment.'})
 
     # Send welcome message
     welcome_message = {
@@ -496,54 +3692,198 @@ def handle_disconnect():
     """Handle client disconnection."""
     session_id = request.sid
     logger.info(f"Client disconnected: {session_id}")
-    if session_id in chat_history:
-        del chat_history[session_id]
+    metrics.inc("exam_connected_sessions", -1)
+    query_scheduler.cancel(session_id)
+    wait_for(submit_in_context(query_executor, session_store.clear, session_id))
 
-@socketio.on('message')
-def handle_message(data):
-    """Handle incoming messages."""
-    session_id = request.sid
+class QueryCancelled(Exception):
+    """Raised inside a running query when its client has disconnected."""
+
+class QueryJob:
+    """One chat message waiting for or being answered by process_query."""
+
+    def __init__(self, session_id, data):
+        self.session_id = session_id
+        self.data = data
+        self.cancelled = False
+        self.position = 0  # Jobs ahead of it in its session's queue when submitted
+        self.submitted = time.perf_counter()
+
+class QueryScheduler:
+    """Runs chat queries outside the Socket.IO handlers with per-session ordering and global limits.
+
+    Each session has a FIFO of jobs with at most one running, drained by a background task while
+    the session has work. A session may queue session_depth jobs behind its running one, and at
+    most max_pending jobs are queued or running server-wide; submit() rejects anything beyond
+    that so the caller can tell the client the server is busy. cancel() drops a disconnected
+    session's queued jobs and flags its running job so it stops early.
+    """
+
+    def __init__(self, handler, max_pending, session_depth):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.session_depth = session_depth
+        self.pending = 0
+        self._sessions = {}  # session_id -> deque of jobs; the head is running
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, data):
+        """Queue a message; returns (job, None), or (None, "server"/"session") if that limit is reached."""
+        job = QueryJob(session_id, data)
+        with self._lock:
+            if self.pending >= self.max_pending:
+                return None, "server"
+            jobs = self._sessions.get(session_id)
+            if jobs is not None and len(jobs) > self.session_depth:
+                return None, "session"
+            self.pending += 1
+            if jobs is None:
+                jobs = self._sessions[session_id] = deque()
+                socketio.start_background_task(self._drain, session_id, jobs)
+            job.position = len(jobs)
+            jobs.append(job)
+            return job, None
+
+    def cancel(self, session_id):
+        """Cancel every job of a session."""
+        with self._lock:
+            jobs = self._sessions.pop(session_id, None)
+            if not jobs:
+                return
+            for job in jobs:
+                job.cancelled = True
+            logger.info(f"Cancelled {len(jobs)} queries of disconnected session {session_id}")
+            self.pending -= len(jobs) - 1  # The running job is released by _drain
+            running = jobs[0]
+            jobs.clear()
+            jobs.append(running)
+
+    def _drain(self, session_id, jobs):
+        while True:
+            with self._lock:
+                if not jobs:
+                    if self._sessions.get(session_id) is jobs:
+                        del self._sessions[session_id]
+                    return
+                job = jobs[0]
+            try:
+                self.handler(job)
+            except QueryCancelled:
+                logger.info(f"Stopped query of disconnected session {session_id}")
+            except Exception as e:
+                logger.error(f"Error processing query for {session_id}: {e}")
+            finally:
+                with self._lock:
+                    self.pending -= 1
+                    if jobs and jobs[0] is job:
+                        jobs.popleft()
+
+def wait_for(future, job=None):
+    """Wait for a future from a worker pool without blocking the Socket.IO server."""
+    while not future.done():
+        if job is not None and job.cancelled:
+            future.cancel()
+            raise QueryCancelled()
+        socketio.sleep(query_poll_interval)
+    return future.result()
+
+def process_query(job):
+    """Answer one queued chat message, emitting progress, tokens and the answer to its session.
+
+    Retrieval and cache lookups run in query_executor and generation in llm_executor, while this
+    task only waits on them, so the server keeps handling other clients in the meantime.
+    The query is traced from the moment it was queued; its request ID is sent with every event.
+    """
+    session_id, data = job.session_id, job.data
     query = data.get('content', '').strip()
+    trace = tracer.start("message", start=job.submitted, session_id=session_id, query=query[:200])
+    trace_token = current_trace.set(trace)
+    record_stage("queue_wait", job.submitted, time.perf_counter() - job.submitted)
+    capture = profiler.query_capture(trace.request_id)
 
-    if not query:
-        emit('message', {
-            'type': 'bot',
-            'content': "Please enter a query.",
-            'timestamp': time.time()
-        })
-        return
+    def emit(event, payload):
+        if job.cancelled:
+            raise QueryCancelled()
+        socketio.emit(event, dict(payload, request_id=trace.request_id), to=session_id)
 
-    # Send typing indicator
-    emit('typing', {'status': True})
+    def submit(executor, fn, *args):
+        # Carry the trace into the worker thread, and profile the work there if requested
+        if capture is not None:
+            fn, args = capture.run, (fn,) + args
+        return submit_in_context(executor, fn, *args)
 
     try:
-        # Get session history
-        history = chat_history.get(session_id, [])
+        # Send typing indicator
+        emit('typing', {'status': True})
 
-        # Process query
-        emit('processing', {'status': 'retrieving', 'progress': 0})
+        # Get session history
+        with stage("history"):
+            history = [(entry['query'], entry['response'])
+                       for entry in wait_for(submit(query_executor, session_store.history, session_id), job)]
 
-        # Simulate progress updates for better UX
-        emit('processing', {'status': 'retrieving', 'progress': 30, 'message': 'Searching through summaries...'})
-        time.sleep(0.5)  # Simulate processing time
+        # Queries sent during start-up wait for the warm-up
+        if not index_ready.is_set():
+            emit('processing', {'status': 'warming', 'progress': 0, 'message': 'Loading the index...'})
+            while not index_ready.is_set():
+                if warm_up_state["status"] == "failed":
+                    raise RuntimeError(f"Chatbot failed to initialize: {warm_up_state['error']}")
+                if job.cancelled:
+                    raise QueryCancelled()
+                socketio.sleep(query_poll_interval)
 
-        emit('processing', {'status': 'retrieving', 'progress': 60, 'message': 'Finding relevant chunks...'})
-        docs = hierarchical_retrieval(query, summary_store, chunk_store, k=2)
+        # Process query
+        stream = data.get('stream', stream_responses)
+        emit('processing', {'status': 'retrieving', 'progress': 0, 'message': 'Searching through summaries...'})
 
-        emit('processing', {'status': 'retrieving', 'progress': 100, 'message': 'Retrieval complete'})
-        time.sleep(0.3)  # Simulate processing time
+        # Serve near-identical standalone questions from the answer cache
+        section = (data.get('section') or '').strip() or None  # Restrict retrieval to a TOC section
+        cacheable = section is None and is_history_independent(query, history)
+        cached = wait_for(submit(query_executor, answer_cache.lookup, query), job) if cacheable else None
+        streamed = False
+        if cached:
+            docs, response = cached['docs'], cached['response']
+            emit('processing', {'status': 'generating', 'progress': 100, 'message': 'Response ready'})
+        else:
+            docs = wait_for(submit(query_executor, retrieve, query, 2, section), job)
+            emit('processing', {'status': 'retrieving', 'progress': 100, 'message': 'Retrieval complete'})
 
-        emit('processing', {'status': 'generating', 'progress': 0, 'message': 'Analyzing context...'})
-        time.sleep(0.3)  # Simulate processing time
+            emit('processing', {'status': 'generating', 'progress': 0, 'message': 'Formulating response...'})
+            if stream:
+                tokens = queue.Queue()
 
-        emit('processing', {'status': 'generating', 'progress': 50, 'message': 'Formulating response...'})
-        response = generate_response(query, docs, history)
+                def on_token(token):
+                    if job.cancelled:
+                        raise QueryCancelled()  # Stop generating for a client that has left
+                    tokens.put(token)
 
-        emit('processing', {'status': 'generating', 'progress': 100, 'message': 'Response ready'})
+                future = submit(llm_executor, generate_response, query, docs, history, on_token)
+                while True:
+                    done = future.done()
+                    # Forward every token generated since the last check as one chunk
+                    parts = []
+                    while not tokens.empty():
+                        parts.append(tokens.get_nowait())
+                    if parts:
+                        emit('message_chunk', {'type': 'bot', 'content': "".join(parts)})
+                    if done:
+                        break
+                    if job.cancelled:
+                        raise QueryCancelled()
+                    socketio.sleep(query_poll_interval)
+                response = future.result()
+                streamed = True
+            else:
+                response = wait_for(submit(llm_executor, generate_response, query, docs, history), job)
+                emit('processing', {'status': 'generating', 'progress': 100, 'message': 'Response ready'})
+            if cacheable and docs and response != response_error_message:
+                wait_for(submit(query_executor, answer_cache.put, query, response, docs), job)
 
-        # Update history
-        history.append((query, response))
-        chat_history[session_id] = history[-max_history:]  # Keep only the last max_history entries
+        # Update history (not for a client that disconnected meanwhile)
+        if job.cancelled:
+            raise QueryCancelled()
+        answered_at = time.time()
+        wait_for(submit(query_executor, session_store.append, session_id, query, response, answered_at,
+                        max_history + history_summary_turns), job)
 
         # Prepare context data for visualization
         context_data = []
@@ -553,43 +3893,58 @@ def handle_message(data):
                 'metadata': doc['metadata']
             })
 
-        # Generate confidence metrics (simulated for now)
+        # Page and section of each source, so the client can link straight to the cited pages
+        sources = [dict(source_citation(doc['metadata']), number=i + 1) for i, doc in enumerate(docs)]
+
+        # Confidence metrics derived from the retrieval scores
+        vector_scores = [doc['vector_score'] for doc in docs if doc.get('vector_score') is not None]
         confidence_metrics = {
-            'relevance': min(95, 70 + len(docs) * 10),  # Higher with more docs
-            'accuracy': min(90, 65 + len(docs) * 10),
-            'completeness': min(85, 60 + len(docs) * 10),
-            'coherence': 88,
-            'conciseness': 92
+            # Mean cosine relevance of the retrieved summaries
+            'relevance': round(100 * sum(vector_scores) / len(vector_scores)) if vector_scores else 0,
+            # Relevance of the best supporting chunk
+            'accuracy': round(100 * max(vector_scores)) if vector_scores else 0,
+            # Share of the requested sources that were found
+            'completeness': round(100 * min(1, len(docs) / 2)),
+            # Final ranking score of the retrieved chunks (agreement of the retrievers when hybrid)
+            'coherence': round(100 * sum(doc.get('score', 0) for doc in docs) / len(docs)) if docs else 0,
+            # Share of the answer budget left unused, by word count
+            'conciseness': max(0, round(100 * (1 - len(response.split()) / 400)))
         }
 
-        # Prepare hierarchical visualization data
+        # Hierarchical visualization data with the real retrieval scores
         visualization_data = {
             'query': query,
             'summaries': [
                 {
-                    'text': doc['text'][:150] + '...',
-                    'score': 0.85 - (i * 0.1),  # Simulated scores
+                    'text': doc.get('summary', '')[:150] + '...',
+                    'score': doc['vector_score'],
                     'metadata': doc['metadata']
-                } for i, doc in enumerate(docs[:2])  # Top 2 summaries
+                } for doc in docs if doc.get('vector_score') is not None
             ],
             'chunks': [
                 {
                     'text': doc['text'][:150] + '...',
-                    'score': 0.95 - (i * 0.05),  # Simulated scores
+                    'score': doc.get('score'),
+                    'lexical_score': doc.get('lexical_score'),
                     'metadata': doc['metadata']
-                } for i, doc in enumerate(docs)
+                } for doc in docs
             ]
         }
 
-        # Send response with all the enhanced data
-        emit('message', {
-            'type': 'bot',
-            'content': response,
-            'context': context_data,
-            'confidence': confidence_metrics,
-            'visualization': visualization_data,
-            'timestamp': time.time()
-        })
+        # Send response with all the enhanced data; streamed answers are finalized in place by the client
+        with stage("emit"):
+            emit('message', {
+                'type': 'bot',
+                'content': response,
+                'streamed': streamed,
+                'context': context_data,
+                'sources': sources,
+                'confidence': confidence_metrics,
+                'visualization': visualization_data,
+                'timestamp': answered_at
+            })
+    except QueryCancelled:
+        raise
     except Exception as e:
         logger.error(f"Error processing message: {e}")
         emit('message', {
@@ -599,22 +3954,72 @@ def handle_message(data):
         })
     finally:
         # Stop typing indicator
-        emit('typing', {'status': False})
+        if not job.cancelled:
+            socketio.emit('typing', {'status': False, 'request_id': trace.request_id}, to=session_id)
+        tracer.finish(trace)
+        current_trace.reset(trace_token)
+        if trace.duration >= tracer.slow_threshold:
+            logger.warning(f"Slow query {trace.request_id}: {trace.duration:.2f}s")
+        if capture is not None:
+            logger.info(f"Wrote profile of query {trace.request_id} to {capture.dump(profiler.directory)}")
+
+query_scheduler = QueryScheduler(process_query, max_pending=query_queue_depth, session_depth=session_queue_depth)
+
+@metrics.collector
+def collect_component_metrics():
+    """Read the counters the caches, batcher and scheduler keep themselves."""
+    samples = []
+    for name, cache in (("embedding", embeddings), ("answer", answer_cache), ("page", page_cache)):
+        hits, misses = getattr(cache, "hits", 0), getattr(cache, "misses", 0)
+        samples.append(("exam_cache_hits_total", {"cache": name}, hits))
+        samples.append(("exam_cache_misses_total", {"cache": name}, misses))
+        samples.append(("exam_cache_hit_ratio", {"cache": name}, round(hits / (hits + misses), 4) if hits + misses else 0))
+    samples.append(("exam_queries_pending", {}, query_scheduler.pending))
+    samples.append(("exam_index_ready", {}, 1 if index_ready.is_set() else 0))
+    return samples
+
+@socketio.on('message')
+def handle_message(data):
+    """Queue an incoming message; process_query answers it outside the event handler."""
+    session_id = request.sid
+    query = data.get('content', '').strip()
+
+    if not query:
+        emit('message', {
+            'type': 'bot',
+            'content': "Please enter a query.",
+            'timestamp': time.time()
+        })
+        return
+
+    job, reason = query_scheduler.submit(session_id, data)
+    if job is None:
+        logger.warning(f"Rejected query from {session_id}: {reason} queue is full")
+        emit('busy', {
+            'reason': reason,
+            'message': (
+                "The assistant is answering many questions right now. Please try again in a moment."
+                if reason == "server" else
+                "Please wait for your previous questions to be answered before sending more."
+            )
+        })
+    elif job.position:
+        emit('processing', {'status': 'queued', 'progress': 0, 'message': 'Waiting for your previous question to finish...'})
 
 @socketio.on('get_chat_history')
 def handle_get_chat_history():
     """Get chat history for the current session."""
     session_id = request.sid
-    history = chat_history.get(session_id, [])
+    history = wait_for(submit_in_context(query_executor, session_store.history, session_id))
 
     # Format history for the client
     formatted_history = []
-    for i, (query, response) in enumerate(history):
+    for i, entry in enumerate(history):
         formatted_history.append({
             'id': i,
-            'query': query,
-            'response': response,
-            'timestamp': time.time() - (len(history) - i) * 300  # Simulate timestamps
+            'query': entry['query'],
+            'response': entry['response'],
+            'timestamp': entry['timestamp']
         })
 
     emit('chat_history', {
@@ -625,7 +4030,7 @@ def handle_get_chat_history():
 def handle_clear_chat():
     """Clear chat history for the current session."""
     session_id = request.sid
-    chat_history[session_id] = []
+    wait_for(submit_in_context(query_executor, session_store.clear, session_id))
 
     emit('chat_cleared', {
         'status': 'success',
@@ -636,7 +4041,8 @@ def handle_clear_chat():
 def handle_export_chat(data):
     """Export chat history in the requested format."""
     session_id = request.sid
-    history = chat_history.get(session_id, [])
+    history = [(entry['query'], entry['response'])
+               for entry in wait_for(submit_in_context(query_executor, session_store.history, session_id))]
     format_type = data.get('format', 'markdown')
 
     if not history:
@@ -691,12 +4097,25 @@ def handle_export_chat(data):
         })
 
 if __name__ == "__main__":
-    # Initialize RAG system at startup
-    try:
-        _, summary_store, chunk_store = process_document(pdf_path)
-        logger.info("RAG system initialized successfully")
-    except Exception as e:
-        logger.error(f"Error initializing RAG system: {e}")
+    # Spawned processes (the OCR pool) re-run the main script unless __main__ names itself; they
+    # only need ocr_worker, so don't rebuild the whole app in each of them
+    __spec__ = importlib.machinery.ModuleSpec("__main__", None)
+
+    if sys.argv[1:2] == ["build-snapshot"]:
+        # python app.py build-snapshot [path]: write the index of the PDFs to a snapshot file for other replicas
+        build_snapshot(sys.argv[2] if len(sys.argv) > 2 else index_snapshot_path or "./index.snap")
+        sys.exit(0)
+    if sys.argv[1:2] == ["fetch-tokenizer"]:
+        # python app.py fetch-tokenizer: download the tiktoken encoding into TIKTOKEN_CACHE_DIR, for offline hosts
+        sys.exit(0 if token_encoder() else 1)
+
+    # Open the stores, prime caches and sync the PDFs in the background, so the app serves
+    # static and PDF routes at once and queries from committed batches while ingestion runs.
+    # With the reloader only its serving child does this, not the parent that watches files
+    if not debug_mode or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_warm_up()
 
-    # Run the Flask app with Socket.IO
-    socketio.run(app, debug=True, host='0.0.0.0', port=5001)
+    # Run the Flask app with Socket.IO on the threaded Werkzeug server, which also serves the
+    # WebSocket transport through simple-websocket; allowed outside a TTY (docker, systemd)
+    socketio.run(app, debug=debug_mode, host='0.0.0.0', port=int(os.getenv("PORT", "5001")),
+                 allow_unsafe_werkzeug=True)
@@ -0,0 +1,93 @@
+"""Deterministic offline stand-ins for the OpenAI chat and embedding models.
+
+They implement the LangChain interfaces app.py uses (prompt | llm, invoke, stream,
+embed_documents, embed_query) with configurable latency, so benchmarks run the real pipeline
+without network calls or API costs.
+"""
+import hashlib
+import re
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def stable_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class FakeEmbeddings(Embeddings):
+    """Feature-hashed bag-of-words vectors: texts sharing words are close, equal texts are equal.
+
+    Each call sleeps latency seconds plus per_text seconds per input, like one batched API request.
+    """
+
+    def __init__(self, dim=1536, latency=0.0, per_text=0.0):
+        self.dim = dim
+        self.latency = latency
+        self.per_text = per_text
+        self.calls = 0
+        self.texts = 0
+
+    def _vector(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in WORD_PATTERN.findall(text.lower()):
+            h = stable_hash(word)
+            vector[h % self.dim] += 1.0 if h >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            vector[0], norm = 1.0, 1.0
+        return (vector / norm).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        self.texts += len(texts)
+        time.sleep(self.latency + self.per_text * len(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model answering with response_words words picked deterministically from the prompt.
+
+    latency is the time to the first token; each word then takes token_latency, for both
+    invoke and stream.
+    """
+
+    latency: float = 0.0
+    token_latency: float = 0.0
+    response_words: int = 60
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+        return "fake-benchmark"
+
+    def _respond(self, messages):
+        self.calls += 1
+        prompt = messages[-1].content
+        words = WORD_PATTERN.findall(prompt)
+        start = stable_hash(prompt) % max(1, len(words) - self.response_words)
+        return words[start:start + self.response_words]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        words = self._respond(messages)
+        time.sleep(self.latency + self.token_latency * len(words))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=" ".join(words)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        words = self._respond(messages)
+        time.sleep(self.latency)
+        for i, word in enumerate(words):
+            time.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else " " + word))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
@@ -0,0 +1,246 @@
+"""Offline end-to-end benchmark of app.py with fake OpenAI models.
+
+Generates a synthetic manual (benchmarks/synthetic_pdf.py), replaces the OpenAI chat and
+embedding models with deterministic stand-ins with configurable latency (benchmarks/fakes.py)
+and measures:
+
+- extract: extract_text_from_pdf throughput
+- ingest: process_document into empty stores, then again for the unchanged PDF
+- retrieval: hierarchical_retrieval latency, one query at a time and from concurrent threads
+- routes: the /pdf routes through the Flask test client
+- socketio: concurrent Socket.IO test clients sending chat messages through handle_message
+
+Everything runs in process in a temporary directory, so the Socket.IO transport is not
+measured. Prints one JSON report with throughput and p50/p95/p99 latencies.
+
+Usage: python benchmarks/pipeline.py [--pages 100] [--queries 100] [--clients 8]
+           [--messages-per-client 5] [--llm-latency 0.5] [--token-latency 0.01]
+           [--embedding-latency 0.1] [--sections extract,ingest,retrieval,routes,socketio]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fakes import FakeChatModel, FakeEmbeddings
+from synthetic_pdf import sample_queries, write_manual
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECTIONS = ("extract", "ingest", "retrieval", "routes", "socketio")
+
+
+def latency_summary(latencies, elapsed=None):
+    """Latency percentiles in ms, plus throughput per second when the wall time is given."""
+    report = {"count": len(latencies)}
+    if latencies:
+        report.update({
+            "mean_ms": round(float(np.mean(latencies)) * 1000, 3),
+            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+            "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 3)
+        })
+    if elapsed:
+        report["per_s"] = round(len(latencies) / elapsed, 2)
+    return report
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_extract(app, pdf, pages):
+    text, elapsed = timed(app.extract_text_from_pdf, pdf)
+    return {"pages": pages, "characters": len(text), "seconds": round(elapsed, 3), "pages_per_s": round(pages / elapsed, 1)}
+
+
+def bench_ingest(app, pdf, llm, embedding_model):
+    (count, _, _), cold = timed(app.process_document, pdf)
+    _, unchanged = timed(app.process_document, pdf)
+    return {
+        "chunks": count,
+        "seconds": round(cold, 3),
+        "chunks_per_s": round(count / cold, 1),
+        "unchanged_pdf_seconds": round(unchanged, 3),
+        "summary_calls": llm.calls,
+        "embedding_calls": embedding_model.calls
+    }
+
+
+def bench_retrieval(app, queries, clients):
+    app.load_document_shards()
+    shard = app.primary_shard
+
+    def search(query):
+        start = time.perf_counter()
+        app.hierarchical_retrieval(
+            query, shard.summary_store, shard.chunk_store,
+            lexical_index=shard.lexical_index if app.hybrid_retrieval else None,
+            chunk_map=shard.chunk_map or None
+        )
+        return time.perf_counter() - start
+
+    sequential = [search(query) for query in queries]
+    # Reversed so the concurrent run doesn't only hit the embedding cache warmed above
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        concurrent = list(executor.map(search, [query[::-1] for query in queries]))
+    elapsed = time.perf_counter() - start
+    return {
+        "sequential": latency_summary(sequential, sum(sequential)),
+        "concurrent": dict(latency_summary(concurrent, elapsed), threads=clients)
+    }
+
+
+def bench_routes(app, pages, requests_per_route):
+    client = app.app.test_client()
+    page_nums = [i * pages // requests_per_route for i in range(requests_per_route)]
+    routes = {
+        "/pdf": ["/pdf"] * requests_per_route,
+        "/pdf/<n>": [f"/pdf/{n}" for n in page_nums],
+        "/pdf/<n>/image (render)": [f"/pdf/{n}/image?zoom=1.5" for n in page_nums],
+        "/pdf/<n>/image (cached)": [f"/pdf/{n}/image?zoom=1.5" for n in page_nums],
+        "/pdf/thumbnails": [f"/pdf/thumbnails?start={n}" for n in page_nums],
+        "/pdf/outline": ["/pdf/outline"] * requests_per_route,
+        "/pdf/search": [f"/pdf/search?query={word}" for word in ("examination", "fee", "medical", "grievance")
+                        for _ in range(requests_per_route // 4 or 1)]
+    }
+    report = {}
+    for name, urls in routes.items():
+        latencies, errors = [], 0
+        for url in urls:
+            response, elapsed = timed(client.get, url)
+            latencies.append(elapsed)
+            errors += response.status_code != 200
+        report[name] = dict(latency_summary(latencies, sum(latencies)), errors=errors)
+    return report
+
+
+def bench_socketio(app, queries, clients, messages_per_client, timeout):
+    """Each client sends its next message as soon as the previous answer arrives."""
+    sockets = [app.socketio.test_client(app.app) for _ in range(clients)]
+    for socket in sockets:
+        socket.get_received()  # Welcome message
+    plans = [[queries[(i * messages_per_client + j) % len(queries)] for j in range(messages_per_client)]
+             for i in range(clients)]
+    sent_at, first_token_at = {}, {}
+    latencies, first_token, busy = [], [], 0
+
+    def send(i):
+        sent_at[i] = time.perf_counter()
+        sockets[i].emit('message', {'content': plans[i].pop(0)})
+
+    start = time.perf_counter()
+    for i in range(clients):
+        send(i)
+    while sent_at and time.perf_counter() - start < timeout:
+        app.socketio.sleep(0.001)  # Let the query tasks run
+        for i in list(sent_at):
+            for event in sockets[i].get_received():
+                now = time.perf_counter()
+                if event['name'] == 'message_chunk' and i not in first_token_at:
+                    first_token_at[i] = now
+                    first_token.append(now - sent_at[i])
+                elif event['name'] in ('message', 'busy'):
+                    if event['name'] == 'busy':
+                        busy += 1
+                    else:
+                        latencies.append(now - sent_at.pop(i))
+                    sent_at.pop(i, None)
+                    first_token_at.pop(i, None)
+                    if plans[i]:
+                        send(i)
+    elapsed = time.perf_counter() - start
+    for socket in sockets:
+        socket.disconnect()
+    return {
+        "clients": clients,
+        "messages": clients * messages_per_client,
+        "answered": len(latencies),
+        "busy": busy,
+        "timed_out": len(sent_at),
+        "seconds": round(elapsed, 3),
+        "message_latency": latency_summary(latencies, elapsed),
+        "first_token_latency": latency_summary(first_token)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--messages-per-client", type=int, default=5)
+    parser.add_argument("--route-requests", type=int, default=40, help="Requests per /pdf route")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds to the first token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="Seconds per generated word")
+    parser.add_argument("--response-words", type=int, default=60)
+    parser.add_argument("--embedding-latency", type=float, default=0.1, help="Seconds per embedding request")
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--sections", default=",".join(SECTIONS))
+    parser.add_argument("--timeout", type=float, default=600, help="Max seconds for the Socket.IO run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Keep app.py's INFO logging")
+    args = parser.parse_args()
+    sections = [section for section in args.sections.split(",") if section]
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f"unknown sections: {', '.join(sorted(unknown))}")
+
+    # app.py keeps its stores and caches in relative paths, so run it inside a scratch directory
+    work_dir = tempfile.mkdtemp(prefix="pipeline-bench-")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    sys.path.insert(0, REPO_ROOT)
+    try:
+        import app
+
+        if not args.verbose:
+            logging.disable(logging.WARNING)
+        llm = FakeChatModel(latency=args.llm_latency, token_latency=args.token_latency, response_words=args.response_words)
+        embedding_model = FakeEmbeddings(dim=args.embedding_dim, latency=args.embedding_latency)
+        app.api_key = "benchmark"
+        app.llm = llm
+        app.embeddings._underlying = embedding_model  # Keep app's embedding cache in front of the fake
+        app.prerender_thumbnails_enabled = False
+
+        pdf = write_manual(os.path.join(work_dir, "manual.pdf"), args.pages, seed=args.seed)
+        app.pdf_path = app.primary_shard.pdf_path = pdf
+        queries = sample_queries(args.queries, seed=args.seed)
+
+        report = {"config": {key: value for key, value in vars(args).items() if key != "verbose"}, "results": {}}
+        results = report["results"]
+        if "extract" in sections:
+            results["extract"] = bench_extract(app, pdf, args.pages)
+        if set(sections) - {"extract"}:
+            ingest = bench_ingest(app, pdf, llm, embedding_model)  # The other sections need the stores
+            if "ingest" in sections:
+                results["ingest"] = ingest
+        if "retrieval" in sections:
+            results["retrieval"] = bench_retrieval(app, queries, args.clients)
+        if "routes" in sections or "socketio" in sections:
+            # Let the background warm-up finish so it doesn't compete with the measured requests
+            app.start_warm_up()
+            while app.warm_up_state["status"] not in ("ready", "failed") or app.warm_up_state["ingesting"]:
+                app.socketio.sleep(0.05)
+        if "routes" in sections:
+            results["routes"] = bench_routes(app, args.pages, args.route_requests)
+        if "socketio" in sections:
+            results["socketio"] = bench_socketio(app, queries, args.clients, args.messages_per_client, args.timeout)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
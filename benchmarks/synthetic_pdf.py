@@ -0,0 +1,84 @@
+"""Generate a synthetic examination manual PDF with any number of pages.
+
+Pages hold numbered sections of policy clauses built from exam vocabulary, and the document has
+a table of contents, so extraction, chunking, retrieval, PDF search and the outline all have
+realistic work to do. Output is deterministic for a given seed.
+
+Usage: python benchmarks/synthetic_pdf.py manual.pdf [--pages 100] [--seed 0]
+"""
+import argparse
+import random
+
+import fitz
+
+TOPICS = {
+    "Re-evaluation": "re-evaluation fee application answer script marks revised result portal",
+    "Medical Absence": "medical certificate absence make-up examination hospital dean approval",
+    "Grievance Redressal": "grievance committee appeal complaint hearing decision working days",
+    "Unfair Means": "unfair means malpractice invigilator penalty debarred mobile phone",
+    "Attendance": "attendance percentage eligibility shortage condonation semester",
+    "Grading": "grade point credit CGPA SGPA relative grading moderation",
+    "Examination Schedule": "date sheet timetable mid-term end-term admit card seating plan",
+    "Backlog": "backlog supplementary examination fail reappear summer term",
+}
+FILLER = (
+    "students shall must the university may within prescribed as per rules office controller "
+    "of examinations submit before after notified school each course applicable"
+).split()
+PAGES_PER_SECTION = 3
+
+
+def clause(rng, topic_words):
+    words = [rng.choice(topic_words if rng.random() < 0.4 else FILLER) for _ in range(rng.randint(12, 24))]
+    words.insert(rng.randrange(len(words)), str(rng.randint(1, 30) * 100))
+    return " ".join(words).capitalize() + "."
+
+
+def write_manual(path, pages, seed=0, clauses_per_page=6):
+    """Write a pages-long manual to path and return path."""
+    rng = random.Random(seed)
+    topics = list(TOPICS.items())
+    doc = fitz.open()
+    toc = []
+    for page_num in range(pages):
+        section = page_num // PAGES_PER_SECTION + 1
+        title, topic_words = topics[(section - 1) % len(topics)]
+        topic_words = topic_words.split()
+        lines = []
+        if page_num % PAGES_PER_SECTION == 0:
+            toc.append([1, f"{section}. {title}", page_num + 1])
+            lines.append(f"{section}. {title}")
+        first = page_num % PAGES_PER_SECTION * clauses_per_page + 1
+        lines.extend(f"{section}.{first + i} {clause(rng, topic_words)}" for i in range(clauses_per_page))
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(60, 60, page.rect.width - 60, page.rect.height - 60), "\n".join(lines), fontsize=9)
+    doc.set_toc(toc)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def sample_queries(count, seed=0):
+    """Student-style questions about the manual's topics."""
+    rng = random.Random(seed)
+    templates = ("What is the {0} for {1}?", "How do I apply for {1} {0}?", "What are the rules on {0} and {2}?",
+                 "Is there a {0} deadline for {1}?", "Explain the {1} {2} policy.")
+    queries = []
+    for _ in range(count):
+        title, topic_words = rng.choice(list(TOPICS.items()))
+        first, second = rng.sample(topic_words.split(), 2)
+        queries.append(rng.choice(templates).format(first, title.lower(), second))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_manual(args.path, args.pages, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Benchmark the NumPy vector store backend against Chroma.
+
+Builds both stores from the same random unit vectors, upserted in ingestion-sized batches, then
+compares build time, single-query latency, batched multi-query throughput and top-k agreement
+with exact search.
+
+Usage: python benchmarks/vector_store.py [--rows 2000] [--dim 1536] [--queries 200] [--k 8] [--batch 32]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from langchain_chroma import Chroma  # noqa: E402
+
+
+def percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3)
+
+
+def time_queries(search, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        latencies.append(time.perf_counter() - start)
+    return {"p50_ms": percentile_ms(latencies, 50), "p95_ms": percentile_ms(latencies, 95), "p99_ms": percentile_ms(latencies, 99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=app.ingest_batch_size, help="rows per upsert")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((args.rows, args.dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    ids = [f"chunk-{i}" for i in range(args.rows)]
+    documents = [f"document {i}" for i in range(args.rows)]
+    metadatas = [{"chunk_id": doc_id, "index": i} for i, doc_id in enumerate(ids)]
+    exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.k]
+
+    def recall(found):
+        return round(float(np.mean([len(set(f) & set(ids[i] for i in e)) / args.k for f, e in zip(found, exact)])), 4)
+
+    work_dir = tempfile.mkdtemp(prefix="vector-bench-")
+    report = {"rows": args.rows, "dim": args.dim, "queries": args.queries, "k": args.k, "batch": args.batch, "backends": {}}
+    try:
+        start = time.perf_counter()
+        chroma = Chroma(collection_name="bench", persist_directory=os.path.join(work_dir, "chroma"),
+                        collection_metadata={"hnsw:space": "cosine"})
+        for i in range(0, args.rows, args.batch):
+            end = i + args.batch
+            chroma._collection.upsert(ids=ids[i:end], embeddings=vectors[i:end].tolist(),
+                                      documents=documents[i:end], metadatas=metadatas[i:end])
+        build = time.perf_counter() - start
+
+        def chroma_search(query):
+            return chroma._collection.query(query_embeddings=[query.tolist()], n_results=args.k)["ids"][0]
+
+        start = time.perf_counter()
+        batched = chroma._collection.query(query_embeddings=queries.tolist(), n_results=args.k)["ids"]
+        batch_time = time.perf_counter() - start
+        report["backends"]["chroma"] = {
+            "build_s": round(build, 3),
+            "single_query": time_queries(chroma_search, queries),
+            "batch_queries_per_s": round(args.queries / batch_time, 1),
+            "recall_at_k": recall(batched)
+        }
+
+        for dtype in ("float32", "float16", "int8"):
+            start = time.perf_counter()
+            store = app.NumpyVectorStore(f"bench-{dtype}", None, os.path.join(work_dir, "numpy"), dtype=dtype)
+            for i in range(0, args.rows, args.batch):
+                end = i + args.batch
+                store.upsert(ids[i:end], vectors[i:end], documents[i:end], metadatas[i:end])
+            store.flush()
+            build = time.perf_counter() - start
+
+            start = time.perf_counter()
+            store = app.NumpyVectorStore(f"bench-{dtype}", None, os.path.join(work_dir, "numpy"), dtype=dtype)
+            load = time.perf_counter() - start
+
+            def numpy_search(query, store=store):
+                return [hit[0] for hit in store.search_vectors([query], k=args.k)[0]]
+
+            start = time.perf_counter()
+            batched = [[hit[0] for hit in hits] for hits in store.search_vectors(queries, k=args.k)]
+            batch_time = time.perf_counter() - start
+            report["backends"][f"numpy-{dtype}"] = {
+                "build_s": round(build, 3),
+                "load_s": round(load, 4),
+                "single_query": time_queries(numpy_search, queries),
+                "batch_queries_per_s": round(args.queries / batch_time, 1),
+                "recall_at_k": recall(batched)
+            }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+"""OCR task run in the ingestion process pool.
+
+Kept apart from app.py so the spawned worker processes import only Pillow and pytesseract, not
+the Flask app, its clients and caches.
+"""
+import time
+from io import BytesIO
+
+import pytesseract
+from PIL import Image
+
+
+def ocr_image(image_bytes, config):
+    """OCR one image; returns (text, seconds)."""
+    start = time.perf_counter()
+    try:
+        text = pytesseract.image_to_string(Image.open(BytesIO(image_bytes)), lang='eng', config=config).strip()
+    except Exception as e:
+        # pytesseract's errors can't be unpickled in the parent, which would break the whole pool
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    return text, time.perf_counter() - start
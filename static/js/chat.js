@@ -36,10 +36,24 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // State variables
     let chatHistory = [];
+    let streamingMessage = null;
+    let streamingText = '';
+    let indexWarming = false;  // Announce index_ready only to clients that saw index_warming
 
     // Initialize Socket.IO
     const socket = io();
 
+    // End a streamed answer that will not be completed: keep the text received so far
+    // (or drop the empty bubble), so the next answer starts in a new message
+    function finishStreaming() {
+        if (streamingMessage && !streamingText) {
+            const bubble = streamingMessage.closest('.message');
+            (bubble || streamingMessage).remove();
+        }
+        streamingMessage = null;
+        streamingText = '';
+    }
+
     // Socket.IO event handlers
     socket.on('connect', function() {
         console.log('Connected to server');
@@ -47,21 +61,60 @@ document.addEventListener('DOMContentLoaded', function() {
 
     socket.on('disconnect', function() {
         console.log('Disconnected from server');
+        finishStreaming();
         addSystemMessage('Connection lost. Please refresh the page.');
     });
 
     socket.on('error', function(data) {
         console.error('Socket error:', data);
+        finishStreaming();
         addSystemMessage(`Error: ${data.message}`);
     });
 
+    socket.on('busy', function(data) {
+        // The server is at capacity and did not queue the message
+        processingOverlay.style.display = 'none';
+        typingIndicator.classList.remove('active');
+        finishStreaming();
+        addSystemMessage(data.message);
+    });
+
+    socket.on('index_warming', function(data) {
+        // The server is still loading its index; questions are queued until it is ready
+        indexWarming = true;
+        addSystemMessage(data.message);
+    });
+
+    socket.on('index_ready', function(data) {
+        if (!indexWarming) return;
+        indexWarming = false;
+        addSystemMessage(data.message);
+    });
+
     socket.on('message', function(data) {
         // Hide processing overlay
         processingOverlay.style.display = 'none';
 
         // Add message to chat
         if (data.type === 'bot') {
-            addBotMessage(data.content);
+            let messageContent;
+            if (data.streamed && streamingMessage) {
+                // Replace the streamed text with the final answer
+                streamingMessage.innerHTML = formatMessage(data.content);
+                messageContent = streamingMessage;
+                streamingMessage = null;
+                streamingText = '';
+                scrollToBottom();
+            } else {
+                // An error or cached answer ends any stream in progress
+                finishStreaming();
+                messageContent = addBotMessage(data.content);
+            }
+
+            // Link the cited pages
+            if (data.sources && data.sources.length > 0) {
+                addSourceLinks(messageContent, data.sources);
+            }
 
             // Update context viewer if context is provided
             if (data.context && data.context.length > 0) {
@@ -87,13 +140,28 @@ document.addEventListener('DOMContentLoaded', function() {
                 type: 'bot',
                 content: data.content,
                 timestamp: data.timestamp,
+                requestId: data.request_id,  // Trace ID for /admin/traces/<id>
                 context: data.context,
+                sources: data.sources,
                 visualization: data.visualization,
                 confidence: data.confidence
             });
         }
     });
 
+    socket.on('message_chunk', function(data) {
+        // Hide processing overlay as soon as the first token arrives
+        processingOverlay.style.display = 'none';
+
+        if (!streamingMessage) {
+            streamingMessage = addBotMessage('');
+            streamingText = '';
+        }
+        streamingText += data.content;
+        streamingMessage.innerHTML = formatMessage(streamingText);
+        scrollToBottom();
+    });
+
     socket.on('typing', function(data) {
         if (data.status) {
             typingIndicator.classList.add('active');
@@ -145,6 +213,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
             // Clear local chat history
             chatHistory = [];
+            finishStreaming();
 
             // Add system message
             addSystemMessage('Chat history cleared');
@@ -382,6 +451,47 @@ document.addEventListener('DOMContentLoaded', function() {
 
         chatMessages.appendChild(messageDiv);
         scrollToBottom();
+        return messageContent;
+    }
+
+    // Show "Sources: p. 12 (section)" under an answer; links open the page in the PDF viewer when there is one
+    function addSourceLinks(messageContent, sources) {
+        const sourcesDiv = document.createElement('div');
+        sourcesDiv.className = 'message-sources';
+        sourcesDiv.appendChild(document.createTextNode('Sources: '));
+
+        const seen = new Set();
+        sources.forEach(source => {
+            if (source.page_start === null || source.page_start === undefined) return;
+            const key = `${source.document}:${source.page_start}:${source.section}`;
+            if (seen.has(key)) return;
+            seen.add(key);
+
+            const first = source.page_start + 1;
+            const last = source.page_end + 1;
+            const link = document.createElement(source.image_url ? 'a' : 'span');
+            link.className = 'source-link';
+            link.textContent = first === last ? `p. ${first}` : `pp. ${first}-${last}`;
+            if (source.section) {
+                link.textContent += ` (${source.section})`;
+                link.title = source.section;
+            }
+            if (source.image_url) {
+                link.href = source.image_url;
+                link.target = '_blank';
+                link.addEventListener('click', function(e) {
+                    if (typeof window.showPdfPage === 'function') {
+                        e.preventDefault();
+                        window.showPdfPage(source.page_start);
+                    }
+                });
+            }
+            sourcesDiv.appendChild(link);
+        });
+
+        if (seen.size > 0) {
+            messageContent.parentNode.insertBefore(sourcesDiv, messageContent.nextSibling);
+        }
     }
 
     function addSystemMessage(content) {
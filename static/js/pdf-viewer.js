@@ -215,7 +215,7 @@ document.addEventListener('DOMContentLoaded', function() {
             .then(response => response.json())
             .then(data => {
                 if (data.status === 'success') {
-                    pdfPage.src = data.image_data;
+                    pdfPage.src = data.image_url;
                     pdfPage.onload = function() {
                         if (pdfLoading) pdfLoading.style.display = 'none';
                         pdfPage.style.opacity = '1';
@@ -244,6 +244,86 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
     
+    // Load thumbnails page by page as the thumbnail strip is scrolled
+    let nextThumbnailStart = 0;
+    let loadingThumbnails = false;
+    let thumbnailObserver = null;
+    let thumbnailSentinel = null;
+
+    function loadThumbnails() {
+        if (!thumbnailsContainer || loadingThumbnails || nextThumbnailStart === null) return;
+        loadingThumbnails = true;
+
+        if (!thumbnailObserver && 'IntersectionObserver' in window) {
+            // Only fetch an image once its thumbnail scrolls into view
+            thumbnailObserver = new IntersectionObserver(entries => {
+                entries.forEach(entry => {
+                    if (!entry.isIntersecting) return;
+                    if (entry.target === thumbnailSentinel) {
+                        loadThumbnails();
+                    } else if (entry.target.dataset.src) {
+                        entry.target.src = entry.target.dataset.src;
+                        delete entry.target.dataset.src;
+                        thumbnailObserver.unobserve(entry.target);
+                    }
+                });
+            }, { root: thumbnailsContainer, rootMargin: '200px' });
+        }
+
+        fetch(`/pdf/thumbnails?start=${nextThumbnailStart}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.status !== 'success') {
+                    console.error('Error loading thumbnails:', data.message);
+                    return;
+                }
+                data.thumbnails.forEach(thumbnail => {
+                    const img = document.createElement('img');
+                    img.className = 'pdf-thumbnail';
+                    img.alt = `Page ${thumbnail.page_num + 1}`;
+                    img.dataset.pageNum = thumbnail.page_num;
+                    if (thumbnailObserver) {
+                        img.dataset.src = thumbnail.image_url;
+                        thumbnailObserver.observe(img);
+                    } else {
+                        img.loading = 'lazy';
+                        img.src = thumbnail.image_url;
+                    }
+                    img.addEventListener('click', function() {
+                        navigateToPdfPage(thumbnail.page_num);
+                    });
+                    thumbnailsContainer.insertBefore(img, thumbnailSentinel);
+                    pdfThumbnails.push(img);
+                });
+                nextThumbnailStart = data.next_start;
+
+                // Fetch the next range when the end of the strip becomes visible
+                if (!thumbnailSentinel) {
+                    thumbnailSentinel = document.createElement('div');
+                    thumbnailSentinel.className = 'pdf-thumbnails-sentinel';
+                    thumbnailsContainer.appendChild(thumbnailSentinel);
+                    if (thumbnailObserver) thumbnailObserver.observe(thumbnailSentinel);
+                }
+                if (nextThumbnailStart === null && thumbnailObserver) {
+                    thumbnailObserver.unobserve(thumbnailSentinel);
+                }
+                updateActiveThumbnail();
+            })
+            .catch(error => {
+                console.error('Error fetching thumbnails:', error);
+            })
+            .finally(() => {
+                loadingThumbnails = false;
+            });
+    }
+
+    // Highlight the thumbnail of the current page
+    function updateActiveThumbnail() {
+        pdfThumbnails.forEach(img => {
+            img.classList.toggle('active', Number(img.dataset.pageNum) === currentPage);
+        });
+    }
+
     // Zoom PDF
     function zoomPdf(delta) {
         currentZoom = Math.max(0.5, Math.min(3, currentZoom + delta));
@@ -277,5 +357,8 @@ document.addEventListener('DOMContentLoaded', function() {
     // Initialize if PDF viewer elements exist
     if (pdfPage) {
         initPdfViewer();
+
+        // Lets chat answers jump to the pages they cite
+        window.showPdfPage = navigateToPdfPage;
     }
 });
@@ -0,0 +1,21 @@
+import app
+
+
+def page(*words):
+    return {
+        "words": list(words),
+        "rects": [[10.0 * i, 0.0, 10.0 * i + 8, 10.0] for i in range(len(words))],
+        "lines": [0] * len(words),
+    }
+
+
+def test_compound_word_is_counted_once():
+    index = app.PdfSearchIndex([page("the", "re-evaluation", "fee", "is", "due", "re", "exam")])
+
+    results = index.search("re")
+    assert [result["count"] for result in results] == [2]
+    assert len(results[0]["rects"]) == 2
+
+    assert index.search("re fee")[0]["count"] == 1
+    assert index.search("evaluation fee")[0]["count"] == 1
+    assert index.search("re evaluation", mode="any")[0]["count"] == 2
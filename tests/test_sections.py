@@ -0,0 +1,19 @@
+import app
+
+SECTIONS = {
+    "5. Attendance": ["a"],
+    "13. Attendance": ["b"],
+    "13. Attendance > 13.1 Rules": ["c"],
+    "2. Examinations > 2.1 Re-evaluation": ["d"],
+    "7. Re-evaluation": ["e"],
+}
+
+
+def test_numbered_heading_matches_only_its_section():
+    assert sorted(app.find_sections(SECTIONS, "5. Attendance")) == ["5. Attendance"]
+    assert sorted(app.find_sections(SECTIONS, "13 Attendance")) == ["13. Attendance", "13. Attendance > 13.1 Rules"]
+    assert sorted(app.find_sections(SECTIONS, "2.1 Re-evaluation")) == ["2. Examinations > 2.1 Re-evaluation"]
+
+
+def test_title_without_numbering_matches_every_section_of_that_title():
+    assert sorted(app.find_sections(SECTIONS, "Re-evaluation")) == ["2. Examinations > 2.1 Re-evaluation", "7. Re-evaluation"]